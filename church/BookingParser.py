@@ -1,86 +1,182 @@
 import datetime
 import json
-import pickle
 from collections import namedtuple
 
-from dateutil.rrule import rruleset, rrule, DAILY, WEEKLY, MONTHLY, weekday, YEARLY
+from dateutil.rrule import DAILY, WEEKLY, MONTHLY, YEARLY
 
-from church import redis
+from church import redis, codec
 from church.ChurchToolsRequests import getAjaxResponse, logging
-from church.config import BOOKINGS_SEARCH_MAX
-from church.utils import get_cache_key
+from church.booking_index import BookingSearchIndex
+from church.config import BOOKINGS_SEARCH_MAX, OCCURRENCES_DAYS_BEFORE, OCCURRENCES_DAYS_AFTER
+from church.occurrences import OccurrenceIndex, Recurrence
+from church.utils import get_cache_key, loadIndex
 
 logger = logging.getLogger(__name__)
 
 
 class BookingParser:
     Range = namedtuple('Range', ['start', 'end'])
+    # increase when the stored bookings change, so bookings stored by older versions are fetched again
+    FORMAT = 3
 
     def __init__(self, login_data, module, func, cache_key):
         self.login_data = login_data
         self.module = module
         self.func = func
         self.cache_key = cache_key
+        self.version = None
 
     def sortBookings(self, entries):
         return sorted(entries, key=lambda b: (b['start'].date(), b['start']))
 
     def getEntries(self, dayRange=8, dayOffset=0, **kwargs):
-        key = get_cache_key(self.login_data, self.cache_key, dayRange=dayRange, dayOffset=dayOffset, useDate=True, **kwargs)
-        logger.debug(key)
-        entries = self._loadCache(key)
+        """
+        Entries from dayOffset to dayOffset + dayRange days from today.
+        They are cached per day (one field per date in a redis hash), kwargs like subsets are applied afterwards.
+        The bot doesn't change bookings, so the cached days are only replaced when the bookings are fetched
+        again (see _updateDays) or after the hash expires.
+        """
+        first_day = datetime.date.today() + datetime.timedelta(days=dayOffset)
+        days = [first_day + datetime.timedelta(days=d) for d in range(dayRange + 1)]
+        key = self._getDaysKey()
+        pipe = redis.pipeline()
+        pipe.get(self.getVersionKey())
+        pipe.hmget(key, ['version'] + [str(day) for day in days])
+        (version, (cached_version, *cached)) = pipe.execute()
+        self.version = version.decode('utf-8') if version else None
+        if not version or version != cached_version:
+            cached = [None] * len(days)
+        day_entries = {day: codec.decode(c) for day, c in zip(days, cached) if c is not None}
         error = None
-        if entries is None:
+        if len(day_entries) < len(days):
             (error, bookings) = self.getAllBookings()
-            #logger.debug(bookings)
             if not bookings:
                 return error if error else 'Konnte Buchungen nicht laden', None
-            Range = namedtuple('Range', ['start', 'end'])
-            # week = Range(start=datetime.now(), end=datetime.now() + timedelta(days=8))
-            entries = []
-            for booking, rules, start, duration in bookings:
-                # print(list(rules))
-                search_range_start = datetime.datetime.combine(datetime.datetime.now().date() + datetime.timedelta(days=dayOffset), datetime.time(0, 0))
-                search_range_end = datetime.datetime.combine(datetime.datetime.now().date() + datetime.timedelta(days=dayOffset + dayRange), datetime.time(23, 59))
-
-                # Check if previous range overlaps
-                rule = rules.before(search_range_start, inc=False)
-                if rule:
-                    rule_start = datetime.datetime.combine(rule, start.time())
-                    rule_end = rule_start + duration
-                    if rule_end > search_range_start:
-                        for day in range(min((rule_end.date() - search_range_start.date()).days, dayRange) + 1):
-                            r = Range(start=search_range_start + datetime.timedelta(days=day), end=rule_start + duration)
-                            entries.append(self._make_entry(r, booking))
-
-                # Check if rule is inside of search range
-                for rule in rules.between(search_range_start, search_range_end, inc=True):
-                    rule_start = datetime.datetime.combine(rule, start.time())
-                    r = Range(start=rule_start, end=rule_start + duration)
-                    entries.append(self._make_entry(r, booking))
-            entries = self.sortBookings(entries, **kwargs)
-            if not error:
-                redis.set(key, pickle.dumps(entries), ex=24 * 3600)
-        return error, entries
+            index = self.getOccurrenceIndex(bookings)
+            if not index.covers(days[0], days[-1]):
+                return error, self.sortBookings(self._expandEntries(bookings, dayRange, dayOffset), **kwargs)
+            missing = {day: self._dayEntries(index, bookings, day) for day in days if day not in day_entries}
+            day_entries.update(missing)
+            if not error and self.version:
+                if cached_version != self.version.encode('utf-8'):
+                    # the bookings were stored by someone else and the cached days weren't updated yet
+                    updated = self._updateDays(bookings, index)
+                    missing = {day: e for day, e in missing.items() if day not in updated}
+                pipe = redis.pipeline()
+                pipe.hset(key, mapping={'version': self.version,
+                                        **{str(day): codec.encode(e) for day, e in missing.items()}})
+                pipe.expire(key, 24 * 3600)
+                pipe.execute()
+
+        # occurrences that started before the first day are shown on each day they last
+        range_start = datetime.datetime.combine(first_day, datetime.time(0, 0))
+        entries = []
+        for day in days:
+            starting, carried = day_entries[day]
+            entries += starting
+            entries += [e for origin, e in carried if origin < range_start]
+        return error, self.sortBookings(entries, **kwargs)
+
+    def _dayEntries(self, index, bookings, day):
+        """(entries starting on day, [(start of the occurrence, entry)] of occurrences that started before)"""
+        starting, carried = index.day(day)
+        return ([self._make_entry(r, bookings[i][0]) for r, i in starting],
+                [(origin, self._make_entry(r, bookings[i][0])) for origin, r, i in carried])
+
+    def _updateDays(self, bookings, index=None):
+        """
+        Brings the cached days up to the current version of the bookings: only days whose entries changed are
+        written again, days outside the rolling window are removed. Returns the days that are still cached.
+        """
+        key = self._getDaysKey()
+        cached = redis.hgetall(key)
+        cached.pop(b'version', None)
+        if not cached:
+            return set()
+        if index is None:
+            index = self.getOccurrenceIndex(bookings)
+        changed = {}
+        removed = []
+        kept = set()
+        for field, data in cached.items():
+            day = datetime.date.fromisoformat(field.decode('utf-8'))
+            if not index.covers(day, day):
+                removed.append(field)
+                continue
+            kept.add(day)
+            entries = self._dayEntries(index, bookings, day)
+            if codec.decode(data) != entries:
+                changed[field] = codec.encode(entries)
+        pipe = redis.pipeline()
+        if removed:
+            pipe.hdel(key, *removed)
+        pipe.hset(key, mapping={'version': self.version, **changed})
+        pipe.execute()
+        return kept
+
+    def _getBookingsKey(self):
+        return get_cache_key(self.login_data, self.cache_key, useDate=True)
+
+    def getVersionKey(self):
+        """Key of the version of the stored bookings, see self.version"""
+        return self._getBookingsKey() + ':version'
+
+    def _getDaysKey(self):
+        return get_cache_key(self.login_data, self.cache_key + ':days')
+
+    def getOccurrenceIndex(self, bookings):
+        """Occurrences of all bookings in the rolling window, built once per version of the bookings and day"""
+        today = datetime.date.today()
+        version = f'{self.version}:{today}' if self.version else None
+        return loadIndex(self.login_data, self.cache_key + ':occurrences', version,
+                         lambda: OccurrenceIndex(bookings,
+                                                 today - datetime.timedelta(days=OCCURRENCES_DAYS_BEFORE),
+                                                 today + datetime.timedelta(days=OCCURRENCES_DAYS_AFTER)),
+                         timeout=24 * 3600)
+
+    def _expandEntries(self, bookings, dayRange, dayOffset):
+        Range = namedtuple('Range', ['start', 'end'])
+        # week = Range(start=datetime.now(), end=datetime.now() + timedelta(days=8))
+        entries = []
+        for booking, rules, start, duration in bookings:
+            # print(list(rules))
+            search_range_start = datetime.datetime.combine(datetime.datetime.now().date() + datetime.timedelta(days=dayOffset), datetime.time(0, 0))
+            search_range_end = datetime.datetime.combine(datetime.datetime.now().date() + datetime.timedelta(days=dayOffset + dayRange), datetime.time(23, 59))
+
+            # Check if previous range overlaps
+            rule = rules.before(search_range_start, inc=False)
+            if rule:
+                rule_start = datetime.datetime.combine(rule, start.time())
+                rule_end = rule_start + duration
+                if rule_end > search_range_start:
+                    for day in range(min((rule_end.date() - search_range_start.date()).days, dayRange) + 1):
+                        r = Range(start=search_range_start + datetime.timedelta(days=day), end=rule_start + duration)
+                        entries.append(self._make_entry(r, booking))
+
+            # Check if rule is inside of search range
+            for rule in rules.between(search_range_start, search_range_end, inc=True):
+                rule_start = datetime.datetime.combine(rule, start.time())
+                r = Range(start=rule_start, end=rule_start + duration)
+                entries.append(self._make_entry(r, booking))
+        return entries
 
     def searchEntries(self, text):
-        text = text.lower()
+        (error, bookings) = self.getAllBookings()
+        if not bookings:
+            return error if error else 'Konnte Buchungen nicht laden', None
+        index = loadIndex(self.login_data, self.cache_key + ':search', self.version,
+                          lambda: BookingSearchIndex(bookings, self._get_search_keys()))
         entries = []
-        error, bookings = self.getEntries(dayRange=365)
         toomany = False
-        for booking in bookings:
-            if 'status_id' in booking and int(booking['status_id']) == 99:
-                continue
-            actual_booking = booking['booking']
-
-            if any(key in actual_booking and actual_booking[key] and text in actual_booking[key].lower()
-                   for key in self._get_search_keys()):
-                #entries += self._parseBookings(booking)
-                entries.append(booking)
-                if len(entries) >= BOOKINGS_SEARCH_MAX:
-                    toomany = True
-                    break
-        # entries = self.sortBookings(entries)
+        # best matching bookings first, their occurrences ordered by date
+        for positions in index.search(text):
+            found = self.sortBookings(self._expandEntries([bookings[i] for i in positions], dayRange=365, dayOffset=0))
+            if len(entries) + len(found) > BOOKINGS_SEARCH_MAX:
+                entries += found[:BOOKINGS_SEARCH_MAX - len(entries)]
+                toomany = True
+                break
+            entries += found
+        entries = self.sortBookings(entries)
         toomanymsg = f"Zu viele Ergebnisse, zeige die ersten {BOOKINGS_SEARCH_MAX}."
         if toomany:
             error = error + toomanymsg if error else toomanymsg
@@ -88,7 +184,24 @@ class BookingParser:
 
     def _loadCache(self, key):
         entr_str = redis.get(key)
-        return pickle.loads(entr_str) if entr_str else None
+        return codec.decode(entr_str) if entr_str else None
+
+    def _loadBookings(self, key):
+        """Loads the parsed bookings and their version"""
+        (entr_str, version) = redis.mget(key, self.getVersionKey())
+        self.version = version.decode('utf-8') if version else None
+        if not self.version or not self.version.startswith(f'{self.FORMAT}:'):
+            return None
+        return codec.decode(entr_str) if entr_str else None
+
+    def _storeBookings(self, key, entries, timeout):
+        self.version = f'{self.FORMAT}:{datetime.datetime.now().timestamp()}'
+        pipe = redis.pipeline()
+        pipe.set(key, codec.encode(entries), ex=timeout)
+        pipe.set(self.getVersionKey(), self.version, ex=timeout)
+        pipe.execute()
+        self._updateDays(entries)
+
     def _parseBookings(self, booking):
         rules, start, duration = self._parseBooking(booking)
         entr = []
@@ -122,71 +235,54 @@ class BookingParser:
 
     def _parseBooking(self, booking):
         start = self._date_parse(booking['startdate'])
-        # if start.date() != date(2017,12, 11):
-        #   continue
-        # print(json.dumps(booking, indent=2))
         start_date = datetime.datetime.combine(start, datetime.time(0, 0))
         end = self._date_parse(booking['enddate'])
         duration = end - start
-        rules = rruleset()
         repeat_id = int(booking['repeat_id'])
         if repeat_id != 0 and repeat_id != 999:
             repeat_until = self._date_parse(booking['repeat_until'])
             repeat_freq = int(booking['repeat_frequence'])
-            # print("Type: %s, Freq: %s, Start: %s, Until: %s" % (repeat_id, repeat_freq, start, repeat_until))
             if repeat_id == 1:  # daily
-                rules.rrule(rrule(DAILY, dtstart=start_date, until=repeat_until, interval=repeat_freq))
-            if repeat_id == 7:  # weekly
-                # print("Start: %s\nUntil: %s\nInterval: %s" % (start, repeat_until, repeat_freq))
-                rules.rrule(rrule(WEEKLY, dtstart=start_date, interval=repeat_freq, until=repeat_until))
+                rules = Recurrence(start_date, DAILY, interval=repeat_freq, until=repeat_until)
+            elif repeat_id == 7:  # weekly
+                rules = Recurrence(start_date, WEEKLY, interval=repeat_freq, until=repeat_until)
             elif repeat_id == 31:  # monthly by datetime
-                rules.rrule(rrule(MONTHLY, dtstart=start_date, until=repeat_until, interval=repeat_freq))
+                rules = Recurrence(start_date, MONTHLY, interval=repeat_freq, until=repeat_until)
             elif repeat_id == 32:  # monthly by weekday
                 repeat_option_id = int(booking['repeat_option_id']) if booking['repeat_option_id'] else 0
                 if repeat_option_id == 6:
                     raise NotImplementedError(
                         "Error: repeat_option_id == 6 not implemented! Booking:\n%s" % json.dumps(booking, indent=2))
-
-                # nthweekOfMonth = (start.day - 1) // 7 + 1
-                nthweekOfMonth = repeat_option_id
-                # print(nthweekOfMonth)
-                rule = rrule(MONTHLY,
-                             dtstart=start_date,
-                             until=repeat_until,
-                             interval=repeat_freq,
-                             byweekday=weekday(start.weekday())(+nthweekOfMonth))
-                # print(rule)
-                rules.rrule(rule)
+                rules = Recurrence(start_date, MONTHLY, interval=repeat_freq, until=repeat_until,
+                                   nth_weekday=(start.weekday(), repeat_option_id))
             elif repeat_id == 365:
-                rules.rrule(rrule(YEARLY, dtstart=start_date, until=repeat_until, interval=repeat_freq))
-        elif repeat_id in [0, 999]:
-            # print("Simple: %s" % start_date)
-            rules.rdate(start_date)
+                rules = Recurrence(start_date, YEARLY, interval=repeat_freq, until=repeat_until)
+            else:
+                rules = Recurrence(start_date)
         else:
-            raise NotImplementedError(
-                "Error: Repeat Frequency is not implemented! Booking:\n%s" % json.dumps(booking, indent=2))
-            print("Error: Repeat Frequency %s:\n%s" % (repeat_freq, json.dumps(booking, indent=2)))
+            rules = Recurrence(start_date)
+            rules.rdate(start_date)
         if 'additions' in booking and booking['additions']:
             adds = booking['additions']
             for a in adds:
                 addition = adds[a]
-                add_date = datetime.datetime.combine(self._date_parse(addition['add_date']), datetime.time(0, 0))
-                # print("Addition: %s" % add_date)
-                rules.rdate(add_date)
+                rules.rdate(self._date_parse(addition['add_date']))
         if 'exceptions' in booking and booking['exceptions']:
-            # print(booking)
             exceptions = booking['exceptions']
             for exc in exceptions:
                 exception = exceptions[exc]
 
                 exc_start = self._date_parse(exception['except_date_start'])
                 exc_end = self._date_parse(exception['except_date_end'])
-                # print("Exception: %s" % exc_start)
                 if exc_start != exc_end:
                     print("Exception has different start and end: %s" % exception)
-                rules.exdate(datetime.datetime.combine(exc_start, datetime.time(0, 0)))
+                rules.exdate(exc_start)
         return rules, start, duration
 
+    def _slimBooking(self, booking):
+        """Only the fields of a booking that are used for entries and the search are kept"""
+        return {k: booking[k] for k in self._get_booking_keys() + self._get_search_keys() if k in booking}
+
     def _make_entry(self, r, booking):
         return {
             'start': r.start,
@@ -195,7 +291,10 @@ class BookingParser:
             'accepted': booking['status_id'] == '2',
             'room': booking['bezeichnung'].strip(),
             'room_num': int(booking['resource_id']),
-            'booking': booking,
         }
+
+    def _get_booking_keys(self):
+        return ['id', 'text', 'status_id', 'bezeichnung', 'resource_id']
+
     def _get_search_keys(self):
         return []
@@ -1,10 +1,16 @@
-import pickle
-from datetime import datetime
+import datetime
+import logging
 
-from church import redis
+import pytz
+
+from church import redis, codec
 from church.BookingParser import BookingParser
+from church.ChurchToolsRequests import getApiResponses
+from church.config import CALENDAR_WINDOW_DAYS, CALENDAR_WINDOW_TTL, CALENDAR_FULL_TTL, TIMEZONE
 from church.utils import get_cache_key
 
+logger = logging.getLogger(__name__)
+
 
 class CalendarBookingParser(BookingParser):
     def __init__(self, *args, **kwargs):
@@ -30,14 +36,48 @@ class CalendarBookingParser(BookingParser):
     #         entries, toomany = entry_data
     #     return entries, toomany
 
-    def getAllBookings(self):
+    def getAllBookings(self, updateCache=False):
+        """
+        All bookings: the next CALENDAR_WINDOW_DAYS days are fetched separately per category (REST API)
+        and replace these days of the less often refreshed full list of bookings.
+        """
         categories, cat_params = self._getCategories()
         if not cat_params:
             return categories, None # categories is error message
         self.categories = categories
 
-        key = get_cache_key(self.login_data, self.cache_key, useDate=True)
-        entries = self._loadCache(key)
+        key = self._getBookingsKey()
+        entries = self._loadBookings(key) if not updateCache else None
+        if not entries:
+            (error, full) = self.getFullBookings()
+            if not full:
+                return error, full
+            first_day = datetime.date.today()
+            last_day = first_day + datetime.timedelta(days=CALENDAR_WINDOW_DAYS)
+            window = self._getWindowBookings(full, first_day, last_day)
+            if window is None:
+                entries = full
+            else:
+                entries = [(booking, rules.without(first_day, last_day), start, duration)
+                           for booking, rules, start, duration in full] + window
+            if not error:
+                self._storeBookings(key, entries, CALENDAR_WINDOW_TTL)
+            return error, entries
+        return None, entries
+
+    def getFullBookingsKey(self):
+        return get_cache_key(self.login_data, self.cache_key + ':full')
+
+    def getFullBookings(self, updateCache=False):
+        """All bookings of all categories including the far future, only refreshed every CALENDAR_FULL_TTL"""
+        categories, cat_params = self._getCategories()
+        if not cat_params:
+            return categories, None
+        self.categories = categories
+
+        key = self.getFullBookingsKey()
+        stored = self._loadCache(key) if not updateCache else None
+        entries = stored[1] if stored and stored[0] == self.FORMAT else None
         if not entries:
             (error, data) = self._ajaxResponse(**cat_params)
 
@@ -49,12 +89,63 @@ class CalendarBookingParser(BookingParser):
                 for b in category:
                     booking = category[b]
                     rules, start, duration = self._parseBooking(booking)
-                    entries.append((booking, rules, start, duration))
+                    entries.append((self._slimBooking(booking), rules, start, duration))
             if not error:
-                redis.set(key, pickle.dumps(entries), ex=3600 * 12)
+                redis.set(key, codec.encode((self.FORMAT, entries)), ex=CALENDAR_FULL_TTL)
             return error, entries
         return None, entries
 
+    def _getWindowBookings(self, full, first_day, last_day):
+        """
+        Occurrences from first_day to last_day as single bookings, None if the REST API isn't available.
+        Links to agendas are taken from the full bookings.
+        The responses have the envelope of the REST API, e.g.
+        {"data": [{"base": {"id": 1, "caption": "Gottesdienst", "startDate": "2024-05-05T08:00:00Z", ...},
+                   "calculated": {"startDate": "2024-05-05T08:00:00Z", "endDate": "2024-05-05T09:30:00Z"}}],
+         "meta": {"count": 1}}
+        """
+        paths = [f'calendars/{c}/appointments?from={first_day}&to={last_day}' for c in self.categories]
+        (error, data) = getApiResponses(paths, login_data=self.login_data, timeout=CALENDAR_WINDOW_TTL)
+        if len(data) < len(paths) or not all(isinstance(data[path], dict) and isinstance(data[path].get('data'), list)
+                                             for path in paths):
+            logger.info(f"Fetching calendar window failed, using all bookings: {error}")
+            return None
+        csevents = {booking['id']: booking['csevents'] for booking, rules, start, duration in full
+                    if 'csevents' in booking}
+        entries = []
+        for c, path in zip(self.categories, paths):
+            for appointment in data[path]['data']:
+                booking = self._parseAppointment(appointment, c)
+                rules, start, duration = self._parseBooking(booking)
+                booking = self._slimBooking(booking)
+                if booking['id'] in csevents:
+                    booking['csevents'] = csevents[booking['id']]
+                entries.append((booking, rules, start, duration))
+        return entries
+
+    def _parseAppointment(self, appointment, category_id):
+        """Occurrence of an appointment of the REST API as booking of the ajax API"""
+        base = appointment.get('base', appointment)
+        calculated = appointment.get('calculated', base)
+        address = base.get('address')
+        return {
+            'id': str(base['id']),
+            'bezeichnung': base.get('caption') or base.get('title') or '',
+            'ort': address.get('meetingAt') or address.get('name') if isinstance(address, dict) else address,
+            'notizen': base.get('note'),
+            'category_id': str(category_id),
+            'startdate': self._api_date_parse(calculated['startDate']).strftime("%Y-%m-%d %H:%M:%S"),
+            'enddate': self._api_date_parse(calculated['endDate']).strftime("%Y-%m-%d %H:%M:%S"),
+            'repeat_id': '0',
+        }
+
+    def _api_date_parse(self, t):
+        """Dates of the REST API are either days or UTC times, the bookings use local times"""
+        if len(t) == 10:
+            return datetime.datetime.strptime(t, "%Y-%m-%d")
+        utc = datetime.datetime.fromisoformat(t.replace('Z', '+00:00'))
+        return utc.astimezone(pytz.timezone(TIMEZONE)).replace(tzinfo=None)
+
     def _getCategories(self):
         key = get_cache_key(self.login_data, self.cache_key + 'master_data')
         cat_data = self._loadCache(key)
@@ -69,7 +160,7 @@ class CalendarBookingParser(BookingParser):
                 cat_params[f'category_ids[{ctr}]'] = c
                 ctr += 1
             cat_data = categories, cat_params
-            redis.set(key, pickle.dumps(cat_data), ex=7 * 24 * 3600)
+            redis.set(key, codec.encode(cat_data), ex=7 * 24 * 3600)
 
         return cat_data
 
@@ -92,10 +183,8 @@ class CalendarBookingParser(BookingParser):
     def _make_entry(self, r, booking):
         event_id = None
         if 'csevents' in booking and booking['csevents']:
-            for event_key in booking['csevents']:
-                event = booking['csevents'][event_key]
-                event_start = self._date_parse(event['startdate'])
-                if event_start == r.start:
+            for event_key, event_start in booking['csevents'].items():
+                if self._date_parse(event_start) == r.start:
                     event_id = event_key
 
         return {
@@ -108,9 +197,19 @@ class CalendarBookingParser(BookingParser):
             'category': self.categories[booking['category_id']]['bezeichnung'],
             'category_id': booking['category_id'],
             'note': booking['notizen'] if 'notizen' in booking else None,
-            'booking': booking,
             'event_id': event_id,
         }
 
+    def _slimBooking(self, booking):
+        slim = super()._slimBooking(booking)
+        # events are only needed for the link to their agenda: event id -> start
+        if 'csevents' in booking and booking['csevents']:
+            slim['csevents'] = {event_key: event['startdate'] for event_key, event in booking['csevents'].items()
+                                if 'eventTemplate' in event and event.get('service_texts')}
+        return slim
+
+    def _get_booking_keys(self):
+        return ['id', 'bezeichnung', 'ort', 'category_id', 'notizen']
+
     def _get_search_keys(self):
         return ['bezeichnung', 'notizen', 'modified_name', 'booking_location', 'booking_note']
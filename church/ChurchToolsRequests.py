@@ -1,12 +1,19 @@
 import json
 import logging
+import os
 import pickle
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
 from urllib.parse import urljoin
-import requests
 
-from church import redis
+from church import redis, spool, codec
+from church.payloads import storePayload, loadPayload, loadPayloads, deletePayload
+from church.config import STALE_HARD_TTL, STALE_REFRESH_WORKERS, SESSION_VALID_TTL, SESSION_REFRESH_AFTER, \
+    BATCH_CONCURRENCY, HTTP_POOL_SIZE, DOWNLOAD_MAX_BYTES, DOWNLOAD_CACHE_TTL
+from church.sessions import get_session, get_timeout
+from church.singleflight import single_flight
 from church.utils import get_cache_key, loadCache
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -14,21 +21,34 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 logger = logging.getLogger(__name__)
 
+# Stale-while-revalidate: after soft_ttl the data is refreshed in the background,
+# until hard_ttl the outdated data is returned immediately (with a note about its age if show_age)
+StalePolicy = namedtuple('StalePolicy', ['soft_ttl', 'hard_ttl', 'show_age'])
+DAILY_DATA = StalePolicy(soft_ttl=24 * 3600, hard_ttl=STALE_HARD_TTL, show_age=True)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=STALE_REFRESH_WORKERS, thread_name_prefix='refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+_batch_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix='batch')
+_batch_limits = {}
+_batch_limits_lock = threading.Lock()
+
 
 def cc_login(cookies, login_data):
     url = urljoin(login_data['url'], '?q=login/ajax')
-    resp = requests.post(url, {
+    resp = get_session(login_data).post(url, {
         'func': 'loginWithToken',
         'token': login_data['token'],
         'id': login_data['personid']
-    }, timeout=45, cookies=cookies)
+    }, timeout=get_timeout('login'), cookies=cookies)
     return resp
 
 
 def cc_func(module, func, cookies, login_data, params={}):
     url = urljoin(login_data['url'], f'?q=church{module}/ajax')
     data = {'func': func, **params}
-    response = requests.post(url, data=data, cookies=cookies, timeout=30)
+    response = get_session(login_data).post(url, data=data, cookies=cookies, timeout=get_timeout('ajax'))
     if json:
         return response.json()
     else:
@@ -37,10 +57,11 @@ def cc_func(module, func, cookies, login_data, params={}):
 
 def cc_api(path, cookies, login_data, returnJson=True, params=None):
     url = urljoin(urljoin(login_data['url'], 'api/'), path)
+    session = get_session(login_data)
     if params:
-        response = requests.post(url, json=params, cookies=cookies, timeout=30)
+        response = session.post(url, json=params, cookies=cookies, timeout=get_timeout('api'))
     else:
-        response = requests.get(url, cookies=cookies, timeout=30)
+        response = session.get(url, cookies=cookies, timeout=get_timeout('api'))
     if response.status_code != 200:
         return {
             "status": "success",
@@ -59,6 +80,33 @@ def get_user_login_key(user_id):
     return f'login:{str(user_id)}'
 
 
+def _get_session_valid_key(login_data):
+    return get_cache_key(login_data, 'login_valid', usePerson=True)
+
+
+def _markSessionValid(login_data):
+    redis.set(_get_session_valid_key(login_data), datetime.now().timestamp(), ex=SESSION_VALID_TTL)
+
+
+def invalidateSession(login_data):
+    redis.delete(_get_session_valid_key(login_data))
+
+
+def _checkSession(cookies, login_data):
+    data = cc_func('resource', 'pollForNews', cookies, login_data=login_data)
+    if not data or 'data' not in data or ('userid' in data['data'] and str(data['data']['userid']) == '-1'):
+        return False
+    userid = data['data']['userid']
+    return bool(userid) and userid != -1
+
+
+def _revalidateSession(login_data, cookies):
+    if _checkSession(cookies, login_data):
+        _markSessionValid(login_data)
+    else:
+        login(login_data, updateCache=True)
+
+
 def login(login_data=None, updateCache=False, login_token=False):
     key = get_cache_key(login_data, 'login_cookies', usePerson=True)
     cookies_pickle = redis.get(key)
@@ -66,27 +114,32 @@ def login(login_data=None, updateCache=False, login_token=False):
 
     # Check if session cookie still valid
     if cookies and not updateCache:
-        data = cc_func('resource', 'pollForNews', cookies, login_data=login_data)
-        if not data or 'data' not in data or ('userid' in data['data'] and str(data['data']['userid']) == '-1'):
-            cookies = None
+        validated = redis.get(_get_session_valid_key(login_data))
+        if validated:
+            # validated recently, refresh the session before it expires
+            if datetime.now().timestamp() - float(validated) > SESSION_REFRESH_AFTER:
+                _runInBackground(_get_session_valid_key(login_data),
+                                 lambda: _revalidateSession(login_data, cookies))
+            return True, cookies
+        if _checkSession(cookies, login_data):
+            _markSessionValid(login_data)
         else:
-            data = data['data']
-            userid = data['userid']
-            if not userid or userid == -1:
-                cookies = None
+            cookies = None
 
     if not cookies or updateCache: # need to login using permanent login key
+        invalidateSession(login_data)
         logger.info(f"Cookie is invalid for {login_data['personid']}")
         key_token = get_cache_key(login_data, 'login_token', usePerson=True)
         login_key_pickle = redis.get(key_token)
         login_key = pickle.loads(login_key_pickle) if login_key_pickle else None
-        resp1 = requests.head(login_data['url'])
+        session = get_session(login_data)
+        resp1 = session.head(login_data['url'], timeout=get_timeout('login'))
         cookies = resp1.cookies
         if not login_key or login_token: # login key not valid, try login token
             logger.info(f"Getting new login token for {login_data['personid']}")
             # oder /api/whoami?loginstr=..&id=..:
             login_url = urljoin(login_data['url'], f"?loginstr={login_data['token']}&id={login_data['personid']}")
-            resp = requests.get(login_url, cookies=cookies, allow_redirects=False)
+            resp = session.get(login_url, cookies=cookies, allow_redirects=False, timeout=get_timeout('login'))
 
             if resp.status_code == 302:
                 data = cc_api(f'persons/{login_data["personid"]}/logintoken', cookies=cookies, login_data=login_data, returnJson=True)
@@ -95,6 +148,7 @@ def login(login_data=None, updateCache=False, login_token=False):
                     # cookies = resp.cookies.get_dict()
                     redis.set(key_token, pickle.dumps(inner_data['data']))
                     redis.set(key, pickle.dumps(cookies.get_dict()))
+                    _markSessionValid(login_data)
                 else:
                     return False, 'Login fehlgeschlagen, bitte log dich neu ein.'
             else: #if 'Der verwendete Login-Link ist nicht mehr aktuell und kann deshalb nicht mehr verwendet werden.' in resp.text:
@@ -107,6 +161,7 @@ def login(login_data=None, updateCache=False, login_token=False):
                 if data['status'] == 'success' and ('message' not in data or '401: Unauthorized' not in data['message']):
                     logger.debug(data)
                     redis.set(key, pickle.dumps(cookies.get_dict()))
+                    _markSessionValid(login_data)
                 else:
                     logger.warning(data)
                     return False, f'Login fehlgeschlagen, bitte log dich neu ein.'
@@ -119,18 +174,33 @@ def login(login_data=None, updateCache=False, login_token=False):
 
 
 def download_file(login_data, url):
+    """
+    Song files are streamed to the spool on disk, redis only keeps their metadata (and the content of text files).
+    Returns (success, {'type': 'file', 'file': opened file}) or (success, {'type': 'msg', 'msg': [text]}),
+    the caller has to close the file.
+    """
     key = get_cache_key(login_data, 'song:download', url)
     res = loadCache(key)
+    if res and res['type'] == 'file':
+        f = spool.open_file(url)
+        if f:
+            return True, dict(res, file=f)
+        res = None
     if not res:
-        (success, res) = login(login_data)
+        (success, cookies) = login(login_data)
         if not success:
-            return False, res
+            return False, {'msg': cookies}
         try:
             # path = 'temp_file'
             logger.debug(f"Donwloading {url}")
-            r = requests.get(url, cookies=res, stream=True, timeout=20)
-            if r.status_code == 200:
-                res = {}
+            with get_session(login_data).get(url, cookies=cookies, stream=True,
+                                             timeout=get_timeout('download')) as r:
+                if r.status_code != 200:
+                    logger.warning(r)
+                    return False, {'msg': r.text[:50]}
+                size = int(r.headers.get('Content-Length') or 0)
+                if size > DOWNLOAD_MAX_BYTES:
+                    raise spool.TooLarge(size)
 
                 if url.endswith('.txt') or url.endswith('.sng'):
                     if url.endswith('.txt'):
@@ -138,25 +208,24 @@ def download_file(login_data, url):
                     else:  # sng
                         msg = [r.text]
 
-                    res.update({
+                    res = {
                         'type': 'msg',
                         'msg': msg,
-                    })
+                    }
+                    redis.set(key, codec.encode(res), ex=DOWNLOAD_CACHE_TTL)
                 else:
-                    bio = BytesIO(r.content)
-                    res.update({
+                    f = spool.store(url, r.iter_content(chunk_size=64 * 1024), DOWNLOAD_MAX_BYTES)
+                    res = {
                         'type': 'file',
-                        'file': bio,
-                    })
-            else:
-                logger.warning(r)
-                res['msg'] = r.text[:50]
-                return False, res
+                        'size': os.fstat(f.fileno()).st_size,
+                    }
+                    redis.set(key, codec.encode(res), ex=DOWNLOAD_CACHE_TTL)
+                    res['file'] = f
+        except spool.TooLarge as e:
+            return False, {'msg': f'Die Datei ist zu groß ({e.args[0] / 1024 / 1024:.0f} MB).'}
         except Exception as e:
             logger.warning(e)
-            res['msg'] = e
-            return False, res
-        redis.set(key, pickle.dumps(res))
+            return False, {'msg': e}
     return True, res
 
 
@@ -165,47 +234,191 @@ def getPersonLink(login_data, id):
     return f'<a href="{url}">'
 
 
-def getAjaxResponse(*args, login_data, isAjax=True, timeout=10, additionalCacheKey=None, **params):
-    key = get_cache_key(login_data, *args, additionalCacheKey=additionalCacheKey, **params)
-    if timeout:
-        resp_str = redis.get(key)
-        resp = json.loads(resp_str.decode('utf-8')) if resp_str else None
-    if not timeout or not resp:
-        relogin = False
-        while True:
+def _loadAjaxCache(key):
+    resp_str = loadPayload(key)
+    return codec.decode(resp_str) if resp_str else None
 
-            (success, cookies) = login(login_data, updateCache=relogin)
-            if not success:
-                return cookies, None
-            try:
-                if isAjax:
-                    resp = cc_func(*args, cookies=cookies, login_data=login_data, params=params)
-                else:
-                    resp = cc_api(*args, cookies=cookies, login_data=login_data, params=params)
-            except Exception as e:
-                resp_str = redis.get(key + "_latest")
-                if resp_str:
-                    resp_time = float(redis.get(key + "_latest:time"))
-                    resp = json.loads(resp_str.decode('utf-8'))
-                    msg = f'Server unavailable. Data is from {datetime.fromtimestamp(resp_time)}'
-                    return msg, resp['data']
-                else:
-                    return "Error: Server unavailable!", None
-            if resp['status'] == 'success':
-                break
-            elif relogin:
-                break
-            else:  # retry
-                relogin = True
-        if resp['status'] != 'success' or 'data' not in resp:
-            if 'message' in resp:
-                return resp['message'], None
+
+def _loadStaleResponse(key, stale):
+    resp_time = redis.get(key + "_latest:time")
+    if not resp_time:
+        return None
+    age = datetime.now().timestamp() - float(resp_time)
+    if age > stale.hard_ttl:
+        return None
+    resp = _loadAjaxCache(key + "_latest")
+    if not resp:
+        return None
+    msg = None
+    if stale.show_age:
+        minutes = int(age // 60)
+        if minutes >= 120:
+            msg = f'Daten sind {minutes // 60} Stunden alt und werden gerade aktualisiert.'
+        else:
+            msg = f'Daten sind {minutes} Minuten alt und werden gerade aktualisiert.'
+    return msg, resp['data']
+
+
+def _runInBackground(key, func):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            logger.info(f"Refreshing {key}")
+            func()
+        except Exception as e:
+            logger.warning(f"Refreshing {key} failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _refresh_executor.submit(run)
+
+
+def _isUnauthorized(resp):
+    return 'message' in resp and str(resp['message']).startswith('401')
+
+
+def getCacheVersion(*args, login_data, additionalCacheKey=None, usePerson=False, **params):
+    """Returns an identifier of the last fetched version of the data, it only changes if the content changes"""
+    key = get_cache_key(login_data, *args, additionalCacheKey=additionalCacheKey, usePerson=usePerson, **params)
+    version = redis.get(key + "_latest:hash") or redis.get(key + "_latest:time")
+    return version.decode('utf-8') if version else None
+
+
+def invalidateAjaxResponse(*args, login_data, additionalCacheKey=None, usePerson=False, **params):
+    deletePayload(get_cache_key(login_data, *args, additionalCacheKey=additionalCacheKey, usePerson=usePerson,
+                                **params))
+
+
+def getAjaxResponse(*args, login_data, isAjax=True, timeout=10, additionalCacheKey=None, stale=None,
+                    updateCache=False, usePerson=False, **params):
+    key = get_cache_key(login_data, *args, additionalCacheKey=additionalCacheKey, usePerson=usePerson, **params)
+    if stale:
+        timeout = stale.soft_ttl
+    if not timeout:
+        return _fetchAjaxResponse(key, *args, login_data=login_data, isAjax=isAjax, timeout=timeout, **params)
+
+    if not updateCache:
+        resp = _loadAjaxCache(key)
+        if resp:
+            return None, resp['data']
+
+    def fetch():
+        return _fetchAjaxResponse(key, *args, login_data=login_data, isAjax=isAjax, timeout=timeout, **params)
+
+    def load():
+        resp = _loadAjaxCache(key)
+        return (None, resp['data']) if resp else None
+
+    if stale and not updateCache:
+        stale_resp = _loadStaleResponse(key, stale)
+        if stale_resp:
+            _runInBackground(key, lambda: single_flight(key, fetch, load))
+            return stale_resp
+    return single_flight(key, fetch, load, refresh=updateCache)
+
+
+def _get_batch_limit(login_data):
+    with _batch_limits_lock:
+        if login_data['url'] not in _batch_limits:
+            _batch_limits[login_data['url']] = threading.BoundedSemaphore(BATCH_CONCURRENCY)
+        return _batch_limits[login_data['url']]
+
+
+def getAjaxResponses(*args, login_data, paramName, values, timeout=10, **params):
+    """
+    getAjaxResponse for several values of one parameter, e.g. getPersonDetails for several ids.
+    Cached responses are loaded with a single MGET, the others are fetched concurrently.
+    Returns the first error and a dict of value -> data.
+    """
+    values = list(dict.fromkeys(values))
+    if not values:
+        return None, {}
+    keys = [get_cache_key(login_data, *args, additionalCacheKey=None, **params, **{paramName: value})
+            for value in values]
+    results = {}
+    missing = []
+    for value, resp_str in zip(values, loadPayloads(keys)):
+        if resp_str:
+            results[value] = codec.decode(resp_str)['data']
+        else:
+            missing.append(value)
+
+    limit = _get_batch_limit(login_data)
+
+    def fetch(value):
+        with limit:
+            return getAjaxResponse(*args, login_data=login_data, timeout=timeout, **params, **{paramName: value})
+
+    error = None
+    for value, (cur_error, data) in zip(missing, _batch_executor.map(fetch, missing)):
+        if data:
+            results[value] = data
+        error = error or cur_error
+    return error, results
+
+
+def getApiResponses(paths, login_data, timeout=10):
+    """
+    getAjaxResponse for several paths of the REST API, fetched concurrently.
+    Returns the first error and a dict of path -> data.
+    """
+    limit = _get_batch_limit(login_data)
+
+    def fetch(path):
+        with limit:
+            return getAjaxResponse(path, login_data=login_data, isAjax=False, timeout=timeout)
+
+    error = None
+    results = {}
+    for path, (cur_error, data) in zip(paths, _batch_executor.map(fetch, paths)):
+        if data is not None:
+            results[path] = data
+        error = error or cur_error
+    return error, results
+
+
+def _fetchAjaxResponse(key, *args, login_data, isAjax, timeout, **params):
+    relogin = False
+    while True:
+
+        (success, cookies) = login(login_data, updateCache=relogin)
+        if not success:
+            return cookies, None
+        try:
+            if isAjax:
+                resp = cc_func(*args, cookies=cookies, login_data=login_data, params=params)
             else:
-                return str(resp), None
+                resp = cc_api(*args, cookies=cookies, login_data=login_data, params=params)
+        except Exception as e:
+            resp_str = loadPayload(key + "_latest")
+            if resp_str:
+                resp_time = float(redis.get(key + "_latest:time"))
+                resp = codec.decode(resp_str)
+                msg = f'Server unavailable. Data is from {datetime.fromtimestamp(resp_time)}'
+                return msg, resp['data']
+            else:
+                return "Error: Server unavailable!", None
+        if resp['status'] == 'success' and not _isUnauthorized(resp):
+            break
+        elif relogin:
+            break
+        else:  # retry
+            relogin = True
+    if resp['status'] != 'success' or 'data' not in resp:
+        if 'message' in resp:
+            return resp['message'], None
         else:
-            resp_str = json.dumps(resp)
-            if timeout:
-                redis.set(key, resp_str, ex=timeout)
-            redis.set(key + "_latest", resp_str)
-            redis.set(key + "_latest:time", datetime.now().timestamp())
+            return str(resp), None
+    else:
+        resp_str = codec.encode(resp, codec.JSON)
+        if timeout:
+            storePayload(key, resp_str, ex=timeout)
+        resp_hash = storePayload(key + "_latest", resp_str)
+        redis.set(key + "_latest:time", datetime.now().timestamp())
+        redis.set(key + "_latest:hash", resp_hash)
     return None, resp['data']
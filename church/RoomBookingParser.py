@@ -1,9 +1,12 @@
+import datetime
 import pickle
 
 from church import redis
 from church.BookingParser import BookingParser
 from church.ChurchToolsRequests import getAjaxResponse
-from church.utils import get_cache_key
+from church.config import CONFLICTS_DAYS
+from church.occurrences import RoomAvailability, findConflicts
+from church.utils import loadIndex
 
 
 class RoomBookingParser(BookingParser):
@@ -36,9 +39,9 @@ class RoomBookingParser(BookingParser):
                 b['start'], sortDict[b['room_num']] if b['room_num'] in sortDict.keys() else 999, b['start']))
         return entries
 
-    def getAllBookings(self):
-        key = get_cache_key(self.login_data, self.cache_key, useDate=True)
-        entries = self._loadCache(key)
+    def getAllBookings(self, updateCache=False):
+        key = self._getBookingsKey()
+        entries = self._loadBookings(key) if not updateCache else None
         if not entries:
             entries = []
             (error, data) = self._ajaxResponse()
@@ -49,12 +52,45 @@ class RoomBookingParser(BookingParser):
                 if int(booking['status_id']) == 99:
                     continue
                 rules, start, duration = self._parseBooking(booking)
-                entries.append((booking, rules, start, duration))
+                entries.append((self._slimBooking(booking), rules, start, duration))
             if not error:
-                redis.set(key, pickle.dumps(entries), ex=12 * 3600)
+                self._storeBookings(key, entries, 12 * 3600)
             return error, entries
         return None, entries
 
+    def getAvailability(self):
+        """Busy times of all rooms, built once per version of the bookings and day"""
+        (error, bookings) = self.getAllBookings()
+        if not bookings:
+            return error if error else 'Konnte Buchungen nicht laden', None
+        index = self.getOccurrenceIndex(bookings)
+        version = f'{self.version}:{datetime.date.today()}' if self.version else None
+        return error, loadIndex(self.login_data, self.cache_key + ':availability', version,
+                                lambda: RoomAvailability(index, bookings), timeout=24 * 3600)
+
+    def getConflicts(self, days=CONFLICTS_DAYS):
+        """Double bookings of rooms within the next days, ordered by their start"""
+        (error, bookings) = self.getAllBookings()
+        if not bookings:
+            return error if error else 'Konnte Buchungen nicht laden', None
+        index = self.getOccurrenceIndex(bookings)
+        first_day = datetime.date.today()
+        last_day = min(first_day + datetime.timedelta(days=days), index.last_day)
+        entries = []
+        for c in findConflicts(index, bookings, first_day, last_day):
+            first, second = bookings[c.first][0], bookings[c.second][0]
+            entries.append({
+                # stays the same while an overlap that started on a previous day is still running
+                'key': f"{c.room}:{first['id']}:{second['id']}:{c.overlap_start:%Y%m%d%H%M}",
+                'start': c.start,
+                'end': c.end,
+                'room': first['bezeichnung'].strip(),
+                'room_num': c.room,
+                'descr': (first['text'], second['text']),
+                'accepted': (first['status_id'] == '2', second['status_id'] == '2'),
+            })
+        return error, entries
+
     room_saal_sorting = {
         7: 1,  # EG großer Saal [Hz]
         9: 2,  # EG Foyer [Hz]
@@ -0,0 +1,89 @@
+import calendar
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+
+from church.person_index import getPersonDataVersion
+from church.utils import loadIndex
+
+# birthdays without a known year are stored with a year before this
+_MIN_YEAR = 1900
+
+
+def _day_of_year(month, day):
+    """Day of the year counted in a leap year, so the 29th of February has its own day"""
+    return datetime.date(2000, month, day).timetuple().tm_yday
+
+
+_FEB_29 = _day_of_year(2, 29)
+
+
+def parseBirthday(person):
+    birthday_str = person.get('geb') or person.get('geburtsdatum')
+    if not birthday_str:
+        return None
+    try:
+        return datetime.datetime.strptime(birthday_str.split(' ')[0], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+class BirthdayIndex:
+    """
+    Birthdays from the geb/geburtsdatum fields of getAllPersonData, sorted by their day of the year.
+    days: day of the year, persons: keys of the persons, years: year of birth
+    """
+    # increase when the structure changes, so indexes stored by older versions are rebuilt
+    FORMAT = 1
+
+    def __init__(self, persons):
+        birthdays = []
+        for n, person in persons.items():
+            birthday = parseBirthday(person) if person else None
+            if birthday:
+                birthdays.append((_day_of_year(birthday.month, birthday.day), n, birthday.year))
+        birthdays.sort()
+        self.days = array('H', (b[0] for b in birthdays))
+        self.persons = [b[1] for b in birthdays]
+        self.years = array('H', (b[2] for b in birthdays))
+
+    def __len__(self):
+        return len(self.persons)
+
+    def _on(self, date):
+        """Positions of the birthdays on date, the 29th of February is celebrated on the 28th in other years"""
+        day = _day_of_year(date.month, date.day)
+        positions = list(range(bisect_left(self.days, day), bisect_right(self.days, day)))
+        if date.month == 2 and date.day == 28 and not calendar.isleap(date.year):
+            positions += range(bisect_left(self.days, _FEB_29), bisect_right(self.days, _FEB_29))
+        return positions
+
+    def between(self, first_day, last_day, only=None):
+        """
+        (date, person key, age) of the birthdays from first_day to last_day, age is None if the year is unknown.
+        only: keys of the persons to include, e.g. the members of a group
+        """
+        found = []
+        day = first_day
+        while day <= last_day:
+            for pos in self._on(day):
+                n = self.persons[pos]
+                if only is None or n in only:
+                    year = self.years[pos]
+                    found.append((day, n, day.year - year if year >= _MIN_YEAR else None))
+            day += datetime.timedelta(days=1)
+        return found
+
+    def upcoming(self, today, days, only=None):
+        return self.between(today, today + datetime.timedelta(days=days - 1), only=only)
+
+    def month(self, year, month, only=None):
+        return self.between(datetime.date(year, month, 1),
+                            datetime.date(year, month, calendar.monthrange(year, month)[1]), only=only)
+
+
+def getBirthdayIndex(login_data, persons):
+    version = getPersonDataVersion(login_data)
+    if version:
+        version = f'{version}:{BirthdayIndex.FORMAT}'
+    return loadIndex(login_data, 'birthday_index', version, lambda: BirthdayIndex(persons))
@@ -1,61 +1,155 @@
 import datetime
-import json
-import pickle
 import re
-from datetime import date
-
-from church import redis
-from church.ChurchToolsRequests import getAjaxResponse, getPersonLink
-from church.utils import get_cache_key, loadCache
-
-
-def parseGeburtstage(login_data):
-    key = get_cache_key(login_data, 'birthdays', useDate=True)
-    msg = loadCache(key)
-    if not msg:
-        (error, data) = getAjaxResponse('home', 'getBlockData', login_data=login_data, timeout=None)
-
-        if not data:
-            print(error)
-            return error
-        else:
-            try:
-                html = data['blocks']['birthday']['html']
-                # soup = BeautifulSoup(html, 'html.parser')
-                # comments = soup.find_all(string=lambda text:isinstance(text, Comment))
-                # [comment.extract() for comment in comments]
-                # row = str(soup.table.tr)
-                split = re.split(
-                    "<td><a (data-person-id='[^']+')[^>]+><img[^>]*></a><td[^>]*><a class='tooltip-person'[^>]*>([^<]+)</a><td[^>]*>([0-9]+)</?[^>]+>",
-                    html)
-                msg = ""
-                p_id = None
-                for line in split:
-                    if not line:
-                        continue
-                    m = re.search('<th colspan="3">([^<]+)<tr>', line)
-                    m2 = re.match('data-person-id=\'([^\']+)\'', line)
-                    if m:
-                        msg += "<i>%s</i>\n" % m.group(1)
-                    elif m2:
-                        p_id = m2.group(1)
-                        msg += getPersonLink(login_data, p_id)
-                    elif re.match('[0-9]+', line):
-                        if p_id:
-                            msg += f"{line} /P{p_id}\n"
-                        else:
-                            msg += f"{line}\n"
-                        p_id = None
-                    elif re.match('[^<>]+', line):
-                        msg += "%s</a>: " % line
-                if error:
-                    msg += f"\n<i>{error}</i>"
+
+from church import subscriptions
+from church.ChurchToolsRequests import getPersonLink, getAjaxResponse, DAILY_DATA
+from church.birthday_index import getBirthdayIndex
+from church.config import BIRTHDAYS_DAYS, BIRTHDAYS_GROUP_DAYS
+from church.digests import getDigest
+from church.master_data import getBlockData, getGroupMembers
+
+_weekdays = ['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So']
+
+
+def parseGeburtstage(login_data, updateDigest=False):
+    """Message parts with the birthdays of the next days"""
+    # the birthdays block only contains persons the user may see
+    return getDigest(login_data, 'birthday_parts', lambda: _renderGeburtstage(login_data), usePerson=True,
+                     update=updateDigest)
+
+
+def _getPersons(login_data):
+    (error, persons) = getAjaxResponse('db', 'getAllPersonData', login_data=login_data, stale=DAILY_DATA)
+    if not persons:
+        return error if error else 'Konnte Daten nicht abrufen!', None, None
+    return error, persons, getBirthdayIndex(login_data, persons)
+
+
+def _day_name(day, today):
+    if day == today:
+        return 'Heute'
+    if day == today + datetime.timedelta(days=1):
+        return 'Morgen'
+    return f'{_weekdays[day.weekday()]}, {day:%d.%m.}'
+
+
+def printBirthdays(login_data, persons, birthdays):
+    today = datetime.date.today()
+    parts = []
+    cur_part = ''
+    cur_day = None
+    for day, n, age in birthdays:
+        if len(cur_part) > 3000:
+            parts.append(cur_part)
+            cur_part = ''
+        if day != cur_day:
+            cur_part += f"<i>{_day_name(day, today)}</i>\n"
+            cur_day = day
+        p = persons[n]
+        cur_part += f"{getPersonLink(login_data, n)}{p['vorname']} {p['name']}</a>"
+        if age is not None:
+            cur_part += f": {age}"
+        cur_part += f" /P{n}\n"
+    if not birthdays:
+        cur_part += "<i>Keine Geburtstage</i>\n"
+    parts.append(cur_part)
+    return parts
+
+
+def _renderGeburtstage(login_data):
+    error, persons, index = _getPersons(login_data)
+    if not index:
+        # no birthdays visible in the person data, use the birthdays block of the start page
+        return _renderGeburtstageBlock(login_data)
+    parts = printBirthdays(login_data, persons, index.upcoming(datetime.date.today(), BIRTHDAYS_DAYS))
+    parts[-1] += "\nDiesen Monat: /geburtstage_monat\nJeden Morgen benachrichtigen: /geburtstage_an"
+    if error:
+        parts[-1] += f"\n<i>{error}</i>"
+    return error, parts
+
+
+def parseGeburtstageMonat(login_data):
+    error, persons, index = _getPersons(login_data)
+    if not index:
+        return [error or "Keine Geburtstage gefunden."]
+    today = datetime.date.today()
+    parts = printBirthdays(login_data, persons, index.month(today.year, today.month))
+    parts[0] = f"<b>Geburtstage im {today:%m/%Y}</b>\n" + parts[0]
+    if error:
+        parts[-1] += f"\n<i>{error}</i>"
+    return parts
+
+
+def parseGeburtstageGruppe(login_data, g_id):
+    error, persons, index = _getPersons(login_data)
+    if not index:
+        return [error or "Keine Geburtstage gefunden."]
+    members = getGroupMembers(login_data, persons).get(g_id, [])
+    parts = printBirthdays(login_data, persons,
+                           index.upcoming(datetime.date.today(), BIRTHDAYS_GROUP_DAYS, only=set(members)))
+    parts[0] = f"<b>Geburtstage der Gruppe</b> /G{g_id}\n" + parts[0]
+    if error:
+        parts[-1] += f"\n<i>{error}</i>"
+    return parts
+
+
+def subscribe(login_data, chat_id, enabled=True):
+    subscriptions.subscribe(login_data, 'birthdays', chat_id, enabled)
+    if enabled:
+        return "Du bekommst jeden Morgen die Geburtstage des Tages."
+    return "Du bekommst keine Geburtstage mehr."
+
+
+def pushBirthdays(bot, login_data):
+    """Sends the birthdays of today to the subscribers of the instance, the message is only built once"""
+    error, persons, index = _getPersons(login_data)
+    if not index:
+        return
+    birthdays = index.upcoming(datetime.date.today(), 1)
+    if birthdays:
+        parts = printBirthdays(login_data, persons, birthdays)
+        subscriptions.notify(bot, login_data, 'birthdays', parts)
+
+
+def _renderGeburtstageBlock(login_data):
+    (error, data) = getBlockData(login_data)
+
+    if not data:
+        print(error)
+        error = error or 'Konnte Daten nicht abrufen!'
+        return error, [error]
+    try:
+        html = data['blocks']['birthday']['html']
+        # soup = BeautifulSoup(html, 'html.parser')
+        # comments = soup.find_all(string=lambda text:isinstance(text, Comment))
+        # [comment.extract() for comment in comments]
+        # row = str(soup.table.tr)
+        split = re.split(
+            "<td><a (data-person-id='[^']+')[^>]+><img[^>]*></a><td[^>]*><a class='tooltip-person'[^>]*>([^<]+)</a><td[^>]*>([0-9]+)</?[^>]+>",
+            html)
+        msg = ""
+        p_id = None
+        for line in split:
+            if not line:
+                continue
+            m = re.search('<th colspan="3">([^<]+)<tr>', line)
+            m2 = re.match('data-person-id=\'([^\']+)\'', line)
+            if m:
+                msg += "<i>%s</i>\n" % m.group(1)
+            elif m2:
+                p_id = m2.group(1)
+                msg += getPersonLink(login_data, p_id)
+            elif re.match('[0-9]+', line):
+                if p_id:
+                    msg += f"{line} /P{p_id}\n"
                 else:
-                    now = datetime.datetime.now()
-                    midnight = datetime.datetime(year=now.year, month=now.month, day=now.day,
-                                                 hour=23, minute=59, second=59)
-                    expiry_time = (midnight - now).seconds
-                    redis.set(key, pickle.dumps(msg), ex=expiry_time)
-            except Exception as e:
-                return "Error while parsing: %s" % e
-    return msg
\ No newline at end of file
+                    msg += f"{line}\n"
+                p_id = None
+            elif re.match('[^<>]+', line):
+                msg += "%s</a>: " % line
+        if error:
+            msg += f"\n<i>{error}</i>"
+        return error, [msg]
+    except Exception as e:
+        msg = "Error while parsing: %s" % e
+        return msg, [msg]
@@ -0,0 +1,66 @@
+import re
+
+from church.person_index import fold
+
+# all substrings up to this length are indexed, longer search terms are split into them
+_GRAM_LENGTH = 3
+
+
+def textGrams(text):
+    return {text[i:i + n] for n in range(1, _GRAM_LENGTH + 1) for i in range(len(text) - n + 1)}
+
+
+def findCandidates(grams, text):
+    """Entries of grams (substring -> entries) that contain all substrings of text, they may still not contain text"""
+    if len(text) <= _GRAM_LENGTH:
+        return grams.get(text, set())
+    candidates = None
+    for gram in {text[i:i + _GRAM_LENGTH] for i in range(len(text) - _GRAM_LENGTH + 1)}:
+        found = grams.get(gram, set())
+        candidates = found if candidates is None else candidates & found
+        if not candidates:
+            break
+    return candidates
+
+
+class BookingSearchIndex:
+    """
+    Text index over the search fields of bookings.
+    texts: booking position -> folded texts of the fields, grams: substring -> booking positions
+    """
+    def __init__(self, bookings, search_keys):
+        self.texts = {}
+        self.grams = {}
+        for i, (booking, rules, start, duration) in enumerate(bookings):
+            if 'status_id' in booking and str(booking['status_id']) == '99':
+                continue
+            texts = [fold(booking[key]) for key in search_keys if key in booking and booking[key]]
+            if not texts:
+                continue
+            self.texts[i] = texts
+            for text in texts:
+                for gram in textGrams(text):
+                    self.grams.setdefault(gram, set()).add(i)
+
+    def search(self, text):
+        """
+        Positions of the bookings containing text in one of their fields, grouped by relevance:
+        whole words first, then beginnings of words, then any other part of a word.
+        """
+        text = fold(text)
+        if not text:
+            return []
+        word = re.compile(r'\b' + re.escape(text) + r'\b')
+        prefix = re.compile(r'\b' + re.escape(text))
+        tiers = ([], [], [])
+        for i in sorted(findCandidates(self.grams, text)):
+            texts = self.texts[i]
+            if not any(text in t for t in texts):
+                continue
+            if any(word.search(t) for t in texts):
+                tiers[0].append(i)
+            elif any(prefix.search(t) for t in texts):
+                tiers[1].append(i)
+            else:
+                tiers[2].append(i)
+        return [tier for tier in tiers if tier]
@@ -9,6 +9,7 @@ import telegram
 from church import redis
 from church.CalendarBookingParser import CalendarBookingParser
 from church.config import CALENDAR_LIST_DESCRIPTION_LIMIT
+from church.digests import getDigest
 from church.markup import RAUM_ZEIT_MARKUP, mainMarkup, EMPTY_MARKUP
 from church.utils import send_message
 
@@ -51,17 +52,22 @@ def parseCalendarByText(login_data, search):
         text[-1] = text[-1] + f'\n<i>{error}</i>'
     return text
 
-def parseCalendarByTime(login_data, dayRange=7, dayOffset=0):
+def parseCalendarByTime(login_data, dayRange=7, dayOffset=0, updateDigest=False):
     parser = CalendarBookingParser(login_data)
+    return getDigest(login_data, f'calendar:{dayRange}:{dayOffset}',
+                     lambda: _renderCalendarByTime(parser, dayRange, dayOffset),
+                     parser=parser, update=updateDigest)
 
+
+def _renderCalendarByTime(parser, dayRange, dayOffset):
     error, entries = parser.getEntries(dayRange, dayOffset)
     if entries is None:
-        return ["Konnte Daten nicht abrufen!"]
+        return error, ["Konnte Daten nicht abrufen!"]
 
     text = printCalendarEntries(entries, printHeute=dayOffset == 0)
     if error:
         text[-1] = text[-1] + f'\n<i>{error}</i>'
-    return text
+    return error, text
 
 
 def printCalendarEntries(entr, sortByCategory=True, withWeekNumbers=False, printHeute=True, fullDate=False):
@@ -108,12 +114,8 @@ def printCalendarEntries(entr, sortByCategory=True, withWeekNumbers=False, print
                 description = description[:CALENDAR_LIST_DESCRIPTION_LIMIT - 5] + '..'
             new_text = "{start}-{end}: {descr}".format(start=start.strftime("%H:%M"), end=end_str, room=e['category'],
                                                        descr=description)
-            if e['event_id']:
-                event_id = e['event_id']
-                booking = e['booking']
-                if 'csevents' in booking and event_id in booking['csevents'] \
-                    and 'eventTemplate' in booking['csevents'][event_id] and booking['csevents'][event_id]['service_texts']:
-                    new_text += f" /A{e['event_id']}"
+            if e['event_id']:  # only set for events with an agenda
+                new_text += f" /A{e['event_id']}"
         else:
             new_text = "{start}-{end} <code>{room}</code>: {descr}".format(start=start.strftime("%H:%M"), end=end_str,
                                                                            room=e['category'], descr=e['descr'][:30])
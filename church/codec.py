@@ -0,0 +1,51 @@
+"""
+Serialization of cached values: the first byte identifies the codec and whether the rest is compressed.
+Values written before (plain JSON or pickle) are still read.
+"""
+import json
+import pickle
+import zlib
+from collections import namedtuple
+
+import orjson
+
+from church.config import CODEC_COMPRESS_MIN_BYTES, CODEC_COMPRESS_LEVEL
+
+Codec = namedtuple('Codec', ['id', 'dumps', 'loads'])
+
+# for data from ChurchTools, only str keys and JSON types
+JSON = Codec(1, orjson.dumps, orjson.loads)
+# for everything else, e.g. parsed bookings and indexes
+PICKLE = Codec(2, lambda obj: pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), pickle.loads)
+
+_codecs = {c.id: c for c in (JSON, PICKLE)}
+# added to the codec id if the data is compressed with zlib
+_COMPRESSED = 0x10
+# first byte of values written with pickle before the codecs existed
+_LEGACY_PICKLE = 0x80
+
+
+def encode(obj, codec=PICKLE):
+    data = codec.dumps(obj)
+    if len(data) >= CODEC_COMPRESS_MIN_BYTES:
+        return bytes([codec.id | _COMPRESSED]) + zlib.compress(data, CODEC_COMPRESS_LEVEL)
+    return bytes([codec.id]) + data
+
+
+def codecOf(data):
+    """Codec that was used to encode data, values written before the codecs existed count as JSON or PICKLE"""
+    codec = _codecs.get(data[0] & ~_COMPRESSED)
+    if codec:
+        return codec
+    return PICKLE if data[0] == _LEGACY_PICKLE else JSON
+
+
+def decode(data):
+    header = data[0]
+    codec = _codecs.get(header & ~_COMPRESSED)
+    if codec:
+        body = memoryview(data)[1:]
+        return codec.loads(zlib.decompress(body) if header & _COMPRESSED else body)
+    if header == _LEGACY_PICKLE:
+        return pickle.loads(data)
+    return json.loads(data)
@@ -0,0 +1,58 @@
+"""
+Compares the cached values in redis in their old format (plain JSON/pickle) with the codec:
+bytes stored and time to decode them, summed up per dataset (first two parts of the key).
+
+    python -m church.codec_benchmark [key pattern]
+"""
+import json
+import pickle
+import sys
+import time
+from collections import defaultdict
+
+from church import redis, codec
+from church.payloads import loadPayload
+
+# number of times each value is decoded to measure the time
+_REPEAT = 5
+
+
+def _decodeTime(decode, data):
+    start = time.perf_counter()
+    for _ in range(_REPEAT):
+        decode(data)
+    return (time.perf_counter() - start) / _REPEAT
+
+
+def benchmark(pattern='*'):
+    datasets = defaultdict(lambda: [0, 0, 0.0, 0, 0.0])
+    for key in redis.scan_iter(match=pattern, count=1000):
+        key = key.decode('utf-8')
+        if key.startswith('payload:') or redis.type(key) != b'string':
+            continue
+        data = loadPayload(key)
+        try:
+            obj = codec.decode(data)
+        except Exception:
+            continue  # not a cached value, e.g. a version
+        if not isinstance(obj, (dict, list, tuple)):
+            continue
+        if codec.codecOf(data) == codec.JSON:
+            old, old_loads, new = json.dumps(obj).encode('utf-8'), json.loads, codec.encode(obj, codec.JSON)
+        else:
+            old, old_loads, new = pickle.dumps(obj), pickle.loads, codec.encode(obj)
+        stats = datasets[':'.join(key.split(':')[:2])]
+        stats[0] += 1
+        stats[1] += len(old)
+        stats[2] += _decodeTime(old_loads, old)
+        stats[3] += len(new)
+        stats[4] += _decodeTime(codec.decode, new)
+
+    print(f"{'Dataset':<40} {'Values':>6} {'Old KB':>10} {'Old ms':>8} {'New KB':>10} {'New ms':>8} {'Ratio':>6}")
+    for name, (count, old_size, old_time, new_size, new_time) in sorted(datasets.items(), key=lambda d: -d[1][1]):
+        print(f"{name[:40]:<40} {count:>6} {old_size / 1024:>10.1f} {old_time * 1000:>8.2f} "
+              f"{new_size / 1024:>10.1f} {new_time * 1000:>8.2f} {new_size / old_size:>6.2f}")
+
+
+if __name__ == '__main__':
+    benchmark(*sys.argv[1:])
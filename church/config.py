@@ -1,4 +1,98 @@
+import os
+import tempfile
+
 # Room/Calendar bookings: max. number of entries
 BOOKINGS_SEARCH_MAX = 20
 # Calendar: Maximum length of the description of an entry in the list
 CALENDAR_LIST_DESCRIPTION_LIMIT = 50
+
+# HTTP: max. number of keep-alive connections per ChurchTools instance
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 8))
+# HTTP: number of retries on connection errors and 502/503/504
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+# HTTP: timeouts (in seconds) per type of request
+HTTP_TIMEOUTS = {
+    'login': 45,
+    'ajax': 30,
+    'api': 30,
+    'download': 20,
+    'photo': 15,
+    'default': 30,
+}
+
+# Cache: max. time (in seconds) to wait for another request fetching the same data
+SINGLE_FLIGHT_WAIT_TIMEOUT = 60
+# Cache: expiry (in seconds) of the redis lock held while fetching data
+SINGLE_FLIGHT_LOCK_TIMEOUT = 120
+# Cache: max. age (in seconds) of outdated data that is still shown while it's being refreshed
+STALE_HARD_TTL = 7 * 24 * 3600
+# Cache: number of threads refreshing outdated data in the background
+STALE_REFRESH_WORKERS = 2
+# Login: time (in seconds) a successfully validated session is trusted without checking it again
+SESSION_VALID_TTL = 15 * 60
+# Login: age (in seconds) after which a trusted session is validated again in the background
+SESSION_REFRESH_AFTER = 10 * 60
+
+# Warmer: interval (in seconds) in which the next dataset is refreshed in the background
+WARMER_INTERVAL = 60
+# Warmer: datasets are refreshed if their cache expires within this time (in seconds)
+WARMER_AHEAD = 30 * 60
+# Warmer: only use logins of users that were active within this time (in seconds)
+WARMER_USER_TTL = 24 * 3600
+# Warmer: time (in seconds) a dataset isn't refreshed again after its refresh failed
+WARMER_RETRY_AFTER = 15 * 60
+
+# HTTP: max. number of concurrent requests per ChurchTools instance when loading several entries at once
+BATCH_CONCURRENCY = 4
+
+# Cache: time (in seconds) master data (groups, group types, services, ..) is cached
+MASTER_DATA_TTL = 6 * 3600
+# Cache: time (in seconds) the personal block data (memberships, birthdays) is cached
+BLOCK_DATA_TTL = 10 * 60
+
+# Room/Calendar bookings: occurrences are precomputed from this many days in the past..
+OCCURRENCES_DAYS_BEFORE = 7
+# ..up to this many days in the future
+OCCURRENCES_DAYS_AFTER = 400
+
+# Rooms: resource types (ids, comma separated) of ChurchTools that are rooms, empty for all resources
+ROOM_RESOURCE_TYPES = [t for t in os.environ.get('ROOM_RESOURCE_TYPES', '').split(',') if t]
+
+# Room conflicts: number of days (from today) checked for double bookings
+CONFLICTS_DAYS = 365
+# Room conflicts: interval (in seconds) in which subscribers are notified about new double bookings
+CONFLICTS_INTERVAL = 3600
+
+# Calendar: the bookings of this many days from today are fetched separately and more often..
+CALENDAR_WINDOW_DAYS = 14
+# ..namely every this many seconds
+CALENDAR_WINDOW_TTL = 2 * 3600
+# Calendar: time (in seconds) all bookings including the far future are cached
+CALENDAR_FULL_TTL = 3 * 24 * 3600
+
+# Birthdays: number of days (from today) shown by the birthday button
+BIRTHDAYS_DAYS = 14
+# Birthdays: number of days (from today) shown for the members of a group
+BIRTHDAYS_GROUP_DAYS = 365
+# Birthdays: hour at which subscribers get the birthdays of the day
+BIRTHDAYS_PUSH_HOUR = 7
+
+# Telegram: time (in seconds) the file id of an uploaded file/photo is reused instead of uploading it again
+MEDIA_FILE_ID_TTL = 30 * 24 * 3600
+
+# Downloads: max. size (in bytes) of a song file, Telegram bots can't send larger files anyway
+DOWNLOAD_MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES', 50 * 1024 * 1024))
+# Downloads: time (in seconds) the metadata and texts of downloaded song files are kept in redis
+DOWNLOAD_CACHE_TTL = 7 * 24 * 3600
+# Spool: directory where downloaded files are kept on disk
+SPOOL_DIR = os.environ.get('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'church-bot-spool'))
+# Spool: max. total size (in bytes) of the files on disk, the least recently used ones are removed first
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 200 * 1024 * 1024))
+
+# Cache: values of at least this size (in bytes) are compressed
+CODEC_COMPRESS_MIN_BYTES = 512
+# Cache: zlib level used to compress values (1: fastest, 9: smallest)
+CODEC_COMPRESS_LEVEL = 6
+
+# Jobs: timezone of the daily jobs (the JobQueue uses UTC otherwise)
+TIMEZONE = os.environ.get('TZ', 'Europe/Berlin')
@@ -0,0 +1,88 @@
+import json
+import logging
+
+from church import redis, warmer, subscriptions
+from church.RoomBookingParser import RoomBookingParser
+
+logger = logging.getLogger(__name__)
+
+
+def _get_reported_key(url):
+    return f'conflicts:reported:{url}'
+
+
+def printConflicts(conflicts):
+    parts = []
+    cur_part = ''
+    not_accepted_hint = False
+    for c in conflicts:
+        start, end = c['start'], c['end']
+        end_str = end.strftime("%H:%M") if start.date() == end.date() else end.strftime("%d.%m. %H:%M")
+        descr = []
+        for text, accepted in zip(c['descr'], c['accepted']):
+            if accepted:
+                descr.append(text[:30])
+            else:
+                descr.append(f"<i>{text[:30]}*</i>")
+                not_accepted_hint = True
+        new_text = f"{start:%d.%m. %H:%M}-{end_str} <code>{c['room']}</code>: {' / '.join(descr)}\n"
+        if len(cur_part) + len(new_text) > 2000:
+            parts.append(cur_part)
+            cur_part = ''
+        cur_part += new_text
+    if not_accepted_hint:
+        cur_part += "<i>* nicht bestätigt</i>\n"
+    if cur_part:
+        parts.append(cur_part)
+    return parts
+
+
+def parseKonflikte(login_data):
+    error, conflicts = RoomBookingParser(login_data).getConflicts()
+    if conflicts is None:
+        return ["Konnte Daten nicht abrufen!\n" + (error or '')]
+    if not conflicts:
+        text = ["Keine Doppelbuchungen gefunden."]
+    else:
+        text = printConflicts(conflicts)
+        text[0] = "<b>Doppelbuchungen</b>\n" + text[0]
+    text[-1] += "\nBenachrichtigung über neue Doppelbuchungen: /konflikte_an, abbestellen: /konflikte_aus"
+    if error:
+        text[-1] += f'\n<i>{error}</i>'
+    return text
+
+
+def subscribe(login_data, chat_id, enabled=True):
+    subscriptions.subscribe(login_data, 'conflicts', chat_id, enabled)
+    if enabled:
+        return "Du wirst über neue Doppelbuchungen benachrichtigt."
+    return "Du wirst nicht mehr über neue Doppelbuchungen benachrichtigt."
+
+
+def checkConflicts(context):
+    """
+    JobQueue callback, notifies the subscribers of each instance about double bookings
+    that weren't there at the last check. The first check only remembers the existing ones.
+    """
+    for login_data in warmer.active_logins():
+        url = login_data['url']
+        try:
+            error, conflicts = RoomBookingParser(login_data).getConflicts()
+        except Exception as e:
+            logger.warning(f"Checking conflicts for {url} failed: {e}")
+            continue
+        if conflicts is None or error:
+            # incomplete data, check again next time
+            continue
+        reported_str = redis.get(_get_reported_key(url))
+        reported = set(json.loads(reported_str)) if reported_str else None
+        redis.set(_get_reported_key(url), json.dumps([c['key'] for c in conflicts]))
+        if reported is None:
+            continue
+        new = [c for c in conflicts if c['key'] not in reported]
+        if not new:
+            continue
+        logger.info(f"{len(new)} new conflicts for {url}")
+        parts = printConflicts(new)
+        parts[0] = "<b>Neue Doppelbuchungen</b>\n" + parts[0]
+        subscriptions.notify(context.bot, login_data, 'conflicts', parts)
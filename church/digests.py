@@ -0,0 +1,32 @@
+import datetime
+import json
+
+from church import redis
+from church.utils import get_cache_key
+
+
+def _seconds_until_midnight():
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(0, 0))
+    return max(int((midnight - now).total_seconds()), 1)
+
+
+def getDigest(login_data, name, render, parser=None, usePerson=False, update=False):
+    """
+    Message parts rendered by render(), which returns (error, parts).
+    They're stored until midnight or until the bookings of parser change, parts with an error aren't stored.
+    usePerson: the parts depend on the permissions of the user, so they're stored per person.
+    """
+    key = get_cache_key(login_data, 'digest', name, useDate=True, usePerson=usePerson)
+    if not update:
+        (digest_str, *version) = redis.mget([key] + ([parser.getVersionKey()] if parser else []))
+        if digest_str:
+            digest = json.loads(digest_str)
+            if not parser or (version[0] and version[0].decode('utf-8') == digest['version']):
+                return digest['parts']
+    error, parts = render()
+    if not error:
+        digest = {'version': parser.version if parser else None, 'parts': parts}
+        redis.set(key, json.dumps(digest), ex=_seconds_until_midnight())
+    return parts
+
@@ -7,9 +7,10 @@ from textwrap import indent
 import telegram
 from telegram import ReplyKeyboardMarkup
 
-from church import groups, redis
-from church.ChurchToolsRequests import getAjaxResponse, getPersonLink
+from church import groups, redis, media
+from church.ChurchToolsRequests import getAjaxResponse, getPersonLink, DAILY_DATA
 from church.markup import MARKUP_SIGNUP_YES, MARKUP_SIGNUP_NO
+from church.master_data import getMasterData, getBlockData, invalidateBlockData
 from church.utils import send_message, loadCache, mode_key
 
 logger = logging.getLogger(__name__)
@@ -54,16 +55,17 @@ def parse_signup(context, update, login_data, reply_markup, text):
                 send_message(context, update, "<b>Anmeldung fehlgeschlagen! Fehler:\n</b>" + data['translatedMessage'],
                              telegram.ParseMode.HTML, reply_markup)
             else:
+                invalidateBlockData(login_data)
                 send_message(context, update, "<b>Erfolgreich angemeldet!</b>",
                              telegram.ParseMode.HTML, reply_markup)
                 #url = groups.get_qrcode(login_data, g_id)
                 qr = groups.get_qrcode(login_data, g_id)
                 if qr:
                     try:
-                        context.bot.send_photo(update.effective_chat.id, photo=qr,
-                                          caption="Hier ist dein QR-Code fürs Check-In",
-                                          parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup,
-                                          timeout=30)
+                        media.sendPhoto(context.bot, update.effective_chat.id, *qr,
+                                        caption="Hier ist dein QR-Code fürs Check-In",
+                                        parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup,
+                                        timeout=30)
                         # context.bot.send_document(update.effective_chat.id, document=url,
                         #                   caption="Hier ist dein QR-Code fürs Check-In",
                         #                   parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup,
@@ -106,9 +108,9 @@ def parse_signup(context, update, login_data, reply_markup, text):
 
 
 def list_events(context, login_data, reply_markup, update):
-    (errorBlock, blockData) = getAjaxResponse("home", "getBlockData", login_data=login_data, timeout=None)
-    (errorMaster, masterData) = getAjaxResponse("db", "getMasterData", login_data=login_data, timeout=None)
-    (errorPerson, persons) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, timeout=24 * 3600)
+    (errorBlock, blockData) = getBlockData(login_data)
+    (errorMaster, masterData) = getMasterData(login_data)
+    (errorPerson, persons) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, stale=DAILY_DATA)
     grouplist = masterData['groups']
     if blockData and masterData and persons:
         try:
@@ -170,7 +172,7 @@ def agenda(context, update, login_data, a_id, reply_markup):
             data = data['data']
 
             try:
-                (error, masterData) = getAjaxResponse("service", "getMasterData", login_data=login_data, timeout=None)
+                (error, masterData) = getMasterData(login_data, module='service')
 
                 (error, eventData) = getAjaxResponse("service", "getAllEventData", login_data=login_data, timeout=600)
                 event = eventData[a_id]
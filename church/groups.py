@@ -1,5 +1,4 @@
 import logging
-import pickle
 import re
 from io import BytesIO
 from urllib.parse import urljoin
@@ -7,9 +6,10 @@ from urllib.parse import urljoin
 import telegram
 import qrcode
 
-from church import redis
+from church import redis, media, codec
 from church.persons import _printPerson, _personGroupAdditionalInfo
-from church.ChurchToolsRequests import getAjaxResponse
+from church.ChurchToolsRequests import getAjaxResponse, DAILY_DATA
+from church.master_data import getMasterData, getBlockData, getGroupSignupInfos, getGroupIndex, getGroupMembers
 from church.utils import get_cache_key, loadCache, send_message
 
 logger = logging.getLogger(__name__)
@@ -57,14 +57,13 @@ def printGroup(login_data, group, persons=None, masterData=None, list=False, onl
     parts.append(cur_part)
 
     if persons:
-        persons_in_group = [persons[p_id]
-                            for p_id in persons
-                            if 'groupmembers' in persons[p_id]
-                            if g_id in persons[p_id]['groupmembers']]
-        if len(persons_in_group) <= 20:
+        members = getGroupMembers(login_data, persons).get(g_id, [])
+        if len(members) <= 20:
             parts += print_group_members(login_data, masterData, persons, g_id)
         else:
             parts.append(f'<b>Teilnehmer</b>: <b>/GP{g_id}</b>\n')
+        if members:
+            parts.append(f'<b>Geburtstage</b>: /GB{g_id}\n')
 
     if 'places' in group and group['places']:
         cur_part = "\n<pre>Treffpunkte</pre>\n"
@@ -104,17 +103,9 @@ def printGroup(login_data, group, persons=None, masterData=None, list=False, onl
 
 def print_group_members(login_data, masterData, persons, g_id):
     max_people = 100
-    (error, block_data) = getAjaxResponse('home', 'getBlockData', login_data=login_data, timeout=None)
-    group_signup_infos = None
-    try:
-        if block_data:
-            group_signup_infos = block_data['blocks']['managemymembership']['data']['chosable']
-    except:
-        pass
-    persons_in_group = [persons[p_id]
-                        for p_id in persons
-                        if 'groupmembers' in persons[p_id]
-                        if g_id in persons[p_id]['groupmembers']]
+    (error, block_data) = getBlockData(login_data)
+    group_signup_infos = getGroupSignupInfos(block_data)
+    persons_in_group = [persons[p_id] for p_id in getGroupMembers(login_data, persons).get(g_id, [])]
     persons_in_group = sorted(persons_in_group, key=lambda p: p['vorname'])
     persons_in_group = sorted(persons_in_group, key=lambda p: p['name'])
     mem_count = len(persons_in_group)
@@ -201,7 +192,7 @@ def findGroup(login_data, name):
     res = loadCache(key)
     error = None
     if not res or True:
-        (error, data) = getAjaxResponse("db", "getMasterData", login_data=login_data, timeout=None)
+        (error, data) = getMasterData(login_data)
         if not data:  # or 'groups':
             return {
                 'success': False,
@@ -218,17 +209,13 @@ def findGroup(login_data, name):
             if g_id in groups:
                 matches.append(groups[g_id])
         else:
-            name = name.lower()
-            for g in data['groups']:
-                group = groups[g]
-                bez = group['bezeichnung']
-                if name in bez.lower():
-                    matches.append(group)
+            for g in getGroupIndex(login_data, data).search(name):
+                matches.append(groups[g])
         t = []
         if len(matches) == 0:
             pass
         elif len(matches) < 10:
-            (error, persons) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, timeout=24 * 3600)
+            (error, persons) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, stale=DAILY_DATA)
 
             if not persons:
                 return {
@@ -278,7 +265,7 @@ def findGroup(login_data, name):
     if error:
         res['msg'].append(f'\n<i>{error}</i>')
     else:
-        redis.set(key, pickle.dumps(res), ex=7 * 24 * 3600)
+        redis.set(key, codec.encode(res), ex=7 * 24 * 3600)
     return res
 
 
@@ -316,7 +303,15 @@ def get_field_info(field, cancel_markup):
     return msg, markup
 
 
+def _make_qrcode(qr_data):
+    qr = qrcode.make(qr_data, box_size=10, border=3)
+    b = BytesIO()
+    qr.save(b, format='PNG')
+    return b.getvalue()
+
+
 def get_qrcode(login_data, group_id):
+    """(source, photo, load) of the check-in QR code, photo is its file id if it was already uploaded"""
     p_id = int(login_data['personid'])
     (error, data) = getAjaxResponse(f'groups/{group_id}/qrcodecheckin', login_data=login_data, isAjax=False,
                                     timeout=None)
@@ -325,11 +320,9 @@ def get_qrcode(login_data, group_id):
         person_id = data['data'][0]['personId']
         domainId = data['data'][0]['domainId']
         qr_data = '/'.join([str(x) for x in [token, person_id, domainId]])
-        qr = qrcode.make(qr_data, box_size=10, border=3)
-        b = BytesIO()
-        qr.save(b, format='PNG')
-        b.seek(0)
-        return b
+        source = media.contentKey(qr_data)
+        load = lambda: _make_qrcode(qr_data)
+        return source, media.getFileId(source) or load(), load
     else:
         return None
     # (error, data) = getAjaxResponse(f'groups/{group_id}/qrcodecheckin/{p_id}/pdf', login_data=login_data, isAjax=False,
@@ -6,10 +6,10 @@ import telegram
 from PIL import Image
 from pyzbar.pyzbar import decode
 from pyzbar.wrapper import ZBarSymbol
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CallbackContext
 
-from church import ChurchToolsRequests, redis
+from church import ChurchToolsRequests, redis, media
 from church.ChurchToolsRequests import get_user_login_key
 
 from church.utils import send_message
@@ -48,13 +48,13 @@ def button(update: Update, context: CallbackContext) -> None:
               '<i>Findest du das auch sehr umständlich?😳 Dann gib mir im ' \
               '<a href="https://forum.church.tools/topic/7564/feature-request-login-mit-oauth">ChurchTools-Forum</a> ein 👍, damit sie das verbessern 🙃</i>'
 
-    with open(photo_path, 'rb') as f:
-        if query.message.photo:
-            query.edit_message_media(media=InputMediaPhoto(media=f, caption=msg, parse_mode=telegram.ParseMode.HTML))
-        else:
-            query.delete_message()
-            context.bot.send_photo(update.effective_message.chat_id, photo=f, caption=msg,
-                           parse_mode=telegram.ParseMode.HTML)
+    source, photo, load = media.resource(photo_path)
+    if query.message.photo:
+        media.editPhoto(query, source, photo, load, caption=msg, parse_mode=telegram.ParseMode.HTML)
+    else:
+        query.delete_message()
+        media.sendPhoto(context.bot, update.effective_message.chat_id, source, photo, load, caption=msg,
+                        parse_mode=telegram.ParseMode.HTML)
 
 
 def photo(update, context):
@@ -138,9 +138,9 @@ def login(context, update, login_data):
             msg = "Du bist erfolgreich eingeloggt! :)\n" \
                   "Du kannst jetzt die Buttons unten nutzen, um Funktionen von ChurchTools aufzurufen. " \
                   "Falls da keine Buttons sind, musst den im Bild markierten Knopf drücken."
-            with open('resources/logged-in.png', 'rb') as f:
-                context.bot.send_photo(update.message.chat_id, photo=f, caption=msg,
-                               parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup)
+            source, photo, load = media.resource('resources/logged-in.png')
+            media.sendPhoto(context.bot, update.message.chat_id, source, photo, load, caption=msg,
+                            parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup)
         else:
             redis.delete(login_key)
             send_message(context, update,
@@ -32,4 +32,5 @@ RAUM_ZEIT_MARKUP_SIMPLE = ['Heute', 'Morgen']
 RAUM_ZEIT_MARKUP_EXTENDED = ['Nächste 7 Tage']
 RAUM_ZEIT_MARKUP = RAUM_ZEIT_MARKUP_SIMPLE + RAUM_ZEIT_MARKUP_EXTENDED
 RAUM_EXTENDED_MARKUP = ['Suche']
+RAUM_FREE_MARKUP = ['Freie Räume']
 EMPTY_MARKUP = ReplyKeyboardRemove()
\ No newline at end of file
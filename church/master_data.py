@@ -0,0 +1,90 @@
+from church.booking_index import textGrams, findCandidates
+from church.ChurchToolsRequests import getAjaxResponse, getCacheVersion, invalidateAjaxResponse
+from church.config import MASTER_DATA_TTL, BLOCK_DATA_TTL, ROOM_RESOURCE_TYPES
+from church.person_index import fold
+from church.utils import loadIndex
+
+
+def getMasterData(login_data, module='db'):
+    return getAjaxResponse(module, 'getMasterData', login_data=login_data, timeout=MASTER_DATA_TTL)
+
+
+def getRooms(login_data):
+    """Rooms from the master data of churchresource as list of (resource id, name), in the order of ChurchTools"""
+    (error, data) = getMasterData(login_data, module='resource')
+    if not data or 'resources' not in data:
+        return error if error else 'Konnte Räume nicht laden', None
+    resources = [r for r in data['resources'].values()
+                 if not ROOM_RESOURCE_TYPES or str(r.get('resourcetype_id')) in ROOM_RESOURCE_TYPES]
+    resources = sorted(resources, key=lambda r: (int(r.get('sortkey') or 0), r['bezeichnung']))
+    return error, [(int(r['id']), r['bezeichnung'].strip()) for r in resources]
+
+
+def getBlockData(login_data):
+    """Block data depends on the user (e.g. own group memberships), so it's cached per person"""
+    return getAjaxResponse('home', 'getBlockData', login_data=login_data, timeout=BLOCK_DATA_TTL, usePerson=True)
+
+
+def invalidateBlockData(login_data):
+    invalidateAjaxResponse('home', 'getBlockData', login_data=login_data, usePerson=True)
+
+
+def getGroupSignupInfos(block_data):
+    try:
+        if block_data:
+            return block_data['blocks']['managemymembership']['data']['chosable']
+    except (KeyError, TypeError):
+        pass
+    return None
+
+
+class GroupIndex:
+    """
+    Lookups derived from getMasterData of churchdb.
+    ids: group ids in the order of ChurchTools, names: folded name per position,
+    grams: substring of a name -> positions, by_type: group type id -> group ids
+    """
+    # increase when the structure changes, so indexes stored by older versions are rebuilt
+    FORMAT = 1
+
+    def __init__(self, master_data):
+        self.ids = []
+        self.names = []
+        self.grams = {}
+        self.by_type = {}
+        for g_id, group in master_data['groups'].items():
+            name = fold(group['bezeichnung'])
+            for gram in textGrams(name):
+                self.grams.setdefault(gram, set()).add(len(self.ids))
+            self.ids.append(g_id)
+            self.names.append(name)
+            self.by_type.setdefault(group['gruppentyp_id'], []).append(g_id)
+
+    def search(self, name):
+        """Ids of the groups whose name contains name"""
+        name = fold(name)
+        if not name:
+            return list(self.ids)
+        return [self.ids[i] for i in sorted(findCandidates(self.grams, name)) if name in self.names[i]]
+
+
+def getGroupIndex(login_data, master_data):
+    version = getCacheVersion('db', 'getMasterData', login_data=login_data)
+    if version:
+        version = f'{version}:{GroupIndex.FORMAT}'
+    return loadIndex(login_data, 'group_index', version, lambda: GroupIndex(master_data))
+
+
+def _buildGroupMembers(persons):
+    members = {}
+    for p_id, person in persons.items():
+        if person and 'groupmembers' in person and person['groupmembers']:
+            for g_id in person['groupmembers']:
+                members.setdefault(g_id, []).append(p_id)
+    return members
+
+
+def getGroupMembers(login_data, persons):
+    """Dict of group id -> keys of the persons in getAllPersonData that are members of the group"""
+    version = getCacheVersion('db', 'getAllPersonData', login_data=login_data)
+    return loadIndex(login_data, 'group_members', version, lambda: _buildGroupMembers(persons))
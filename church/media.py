@@ -0,0 +1,96 @@
+import hashlib
+import logging
+from io import BytesIO
+
+import telegram
+
+from church import redis
+from church.config import MEDIA_FILE_ID_TTL
+
+logger = logging.getLogger(__name__)
+
+
+def _get_file_id_key(source):
+    return f'telegram:file_id:{source}'
+
+
+def contentKey(data):
+    """Source of media that has no URL, e.g. generated images"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def getFileId(source):
+    """Telegram file id of media that was already uploaded, None otherwise"""
+    file_id = redis.get(_get_file_id_key(source))
+    return file_id.decode('utf-8') if file_id else None
+
+
+def remember(source, message):
+    """Stores the file id of the photo or document in message, so source doesn't have to be uploaded again"""
+    if not isinstance(message, telegram.Message):
+        return
+    if message.photo:
+        file_id = message.photo[-1].file_id
+    elif message.document:
+        file_id = message.document.file_id
+    else:
+        return
+    redis.set(_get_file_id_key(source), file_id, ex=MEDIA_FILE_ID_TTL)
+
+
+def forget(source):
+    redis.delete(_get_file_id_key(source))
+
+
+def resource(path):
+    """(source, photo, load) of a file in resources/, photo is its file id if it was already uploaded"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    source = contentKey(data)
+    return source, getFileId(source) or data, lambda: data
+
+
+def _upload(send, source, content, **kwargs):
+    if isinstance(content, bytes):
+        content = BytesIO(content)
+    message = send(content, **kwargs)
+    remember(source, message)
+    return message
+
+
+def _send(send, source, content, load=None, **kwargs):
+    """
+    content is either the file id returned by getFileId or the data (bytes or a file) to upload.
+    load() returns the data again, it's uploaded if the stored file id isn't valid anymore.
+    """
+    if not isinstance(content, str):
+        return _upload(send, source, content, **kwargs)
+    try:
+        return send(content, **kwargs)
+    except telegram.error.BadRequest:
+        logger.warning(f"Stored file id of {source} isn't valid anymore")
+        forget(source)
+        data = load() if load else None
+        if data is None:
+            raise
+    try:
+        return _upload(send, source, data, **kwargs)
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
+
+
+def sendPhoto(bot, chat_id, source, photo, load=None, **kwargs):
+    return _send(lambda p, **kw: bot.send_photo(chat_id, photo=p, **kw), source, photo, load, **kwargs)
+
+
+def sendDocument(bot, chat_id, source, document, load=None, **kwargs):
+    return _send(lambda d, **kw: bot.send_document(chat_id, document=d, **kw), source, document, load, **kwargs)
+
+
+def editPhoto(query, source, photo, load=None, **kwargs):
+    """Replaces the photo of the message of a callback query"""
+    return _send(lambda p, **kw: query.edit_message_media(media=telegram.InputMediaPhoto(media=p, **kw)),
+                 source, photo, load, **kwargs)
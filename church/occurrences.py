@@ -0,0 +1,317 @@
+import calendar
+import copy
+import datetime
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from dateutil.rrule import rruleset, rrule, weekday, DAILY, WEEKLY, MONTHLY, YEARLY
+
+Range = namedtuple('Range', ['start', 'end'])
+# room: resource id, first/second: positions of the bookings, start/end: time both are booked
+# (start is clamped to the first requested day), overlap_start: real start of the overlap
+Conflict = namedtuple('Conflict', ['room', 'start', 'end', 'first', 'second', 'overlap_start'])
+
+# Occurrences are stored as minutes since this date, which keeps the pickled index small
+_EPOCH = datetime.datetime(2000, 1, 1)
+
+
+def _to_minutes(dt):
+    return int((dt - _EPOCH).total_seconds()) // 60
+
+
+def _from_minutes(minutes):
+    return _EPOCH + datetime.timedelta(minutes=minutes)
+
+
+def _from_ordinal(day):
+    return datetime.datetime.fromordinal(day)
+
+
+class OccurrenceIndex:
+    """
+    All occurrences of the bookings between first_day and last_day, sorted by their start.
+    For each booking the last occurrence before first_day is included as well, as it might still be running.
+    Entries refer to bookings by their position in the list of bookings the index was built from.
+    """
+    def __init__(self, bookings, first_day, last_day):
+        self.first_day = first_day
+        self.last_day = last_day
+        window_start = datetime.datetime.combine(first_day, datetime.time(0, 0))
+        window_end = datetime.datetime.combine(last_day, datetime.time(23, 59))
+        occurrences = []
+        max_duration = 0
+        for i, (booking, rules, start, duration) in enumerate(bookings):
+            duration_minutes = int(duration.total_seconds()) // 60
+            max_duration = max(max_duration, duration_minutes)
+            days = rules.between(window_start, window_end, inc=True)
+            before = rules.before(window_start, inc=False)
+            if before:
+                days.insert(0, before)
+            for day in days:
+                rule_start = _to_minutes(datetime.datetime.combine(day, start.time()))
+                occurrences.append((rule_start, rule_start + duration_minutes, i))
+        occurrences.sort()
+        self.max_duration = max_duration
+        self.starts = array('l', (o[0] for o in occurrences))
+        self.ends = array('l', (o[1] for o in occurrences))
+        self.bookings = array('l', (o[2] for o in occurrences))
+
+    def covers(self, first_day, last_day):
+        return self.first_day <= first_day and last_day <= self.last_day
+
+    def query(self, first_day, last_day):
+        """
+        (Range, booking position) of the occurrences starting on the days from first_day to last_day.
+        Earlier occurrences that are still running on first_day are added once per day they last,
+        starting at midnight.
+        """
+        search_start = datetime.datetime.combine(first_day, datetime.time(0, 0))
+        search_start_minutes = _to_minutes(search_start)
+        search_end_minutes = _to_minutes(datetime.datetime.combine(last_day + datetime.timedelta(days=1),
+                                                                   datetime.time(0, 0)))
+        day_range = (last_day - first_day).days
+        found = []
+
+        # last occurrence of each booking before the search range
+        running = {}
+        lo = bisect_left(self.starts, search_start_minutes - self.max_duration)
+        hi = bisect_left(self.starts, search_start_minutes)
+        for pos in range(lo, hi):
+            running[self.bookings[pos]] = pos
+        for booking, pos in running.items():
+            if self.ends[pos] > search_start_minutes:
+                end = _from_minutes(self.ends[pos])
+                for day in range(min((end.date() - first_day).days, day_range) + 1):
+                    found.append((Range(start=search_start + datetime.timedelta(days=day), end=end), booking))
+
+        for pos in range(hi, bisect_left(self.starts, search_end_minutes)):
+            found.append((Range(start=_from_minutes(self.starts[pos]), end=_from_minutes(self.ends[pos])),
+                          self.bookings[pos]))
+        return found
+
+
+    def day(self, day):
+        """
+        (Range, booking position) of the occurrences starting on day and
+        (start of the occurrence, Range from midnight, booking position) of earlier occurrences still running on day
+        """
+        day_start = datetime.datetime.combine(day, datetime.time(0, 0))
+        day_start_minutes = _to_minutes(day_start)
+        running = {}
+        lo = bisect_left(self.starts, day_start_minutes - self.max_duration)
+        hi = bisect_left(self.starts, day_start_minutes)
+        for pos in range(lo, hi):
+            running[self.bookings[pos]] = pos
+        carried = [(_from_minutes(self.starts[pos]), Range(start=day_start, end=_from_minutes(self.ends[pos])), booking)
+                   for booking, pos in running.items() if self.ends[pos] > day_start_minutes]
+        starting = [(Range(start=_from_minutes(self.starts[pos]), end=_from_minutes(self.ends[pos])), self.bookings[pos])
+                    for pos in range(hi, bisect_left(self.starts, day_start_minutes + 24 * 60))]
+        return starting, carried
+
+
+class RoomAvailability:
+    """
+    Busy times of each room in the window of an OccurrenceIndex.
+    Overlapping occurrences are merged, so the busy times of a room are sorted disjoint intervals
+    (starts, ends in minutes) and each lookup is a binary search.
+    """
+    def __init__(self, index, bookings):
+        self.first_day = index.first_day
+        self.last_day = index.last_day
+        busy = {}
+        for start, end, i in zip(index.starts, index.ends, index.bookings):
+            busy.setdefault(int(bookings[i][0]['resource_id']), []).append((start, end))
+        self.starts = {}
+        self.ends = {}
+        for room, intervals in busy.items():
+            merged = []
+            for start, end in sorted(intervals):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[room] = array('l', (m[0] for m in merged))
+            self.ends[room] = array('l', (m[1] for m in merged))
+
+    def covers(self, start, end):
+        return self.first_day <= start.date() and end.date() <= self.last_day
+
+    def isFree(self, room, start, end):
+        if room not in self.ends:
+            return True
+        # first busy time ending after start
+        i = bisect_right(self.ends[room], _to_minutes(start))
+        return i == len(self.ends[room]) or self.starts[room][i] >= _to_minutes(end)
+
+    def freeRooms(self, rooms, start, end):
+        return [room for room in rooms if self.isFree(room, start, end)]
+
+    def nextFreeSlot(self, room, after, duration):
+        """Start of the first free time of at least duration beginning at or after after, None if not in the window"""
+        slot = _to_minutes(after)
+        minutes = int(duration.total_seconds()) // 60
+        if room in self.ends:
+            starts, ends = self.starts[room], self.ends[room]
+            i = bisect_right(ends, slot)
+            while i < len(ends) and starts[i] < slot + minutes:
+                slot = max(slot, ends[i])
+                i += 1
+        start = _from_minutes(slot)
+        return start if (start + duration).date() <= self.last_day else None
+
+
+def findConflicts(index, bookings, first_day, last_day):
+    """
+    Overlapping occurrences of different bookings of the same room between first_day and last_day.
+    Sweeps over the occurrences ordered by start and keeps the running occurrences of each room in a heap
+    ordered by their end, so every occurrence is only compared with the ones it overlaps.
+    """
+    range_start = _to_minutes(datetime.datetime.combine(first_day, datetime.time(0, 0)))
+    range_end = _to_minutes(datetime.datetime.combine(last_day + datetime.timedelta(days=1), datetime.time(0, 0)))
+    running = {}
+    conflicts = []
+    for pos in range(bisect_left(index.starts, range_start - index.max_duration),
+                     bisect_left(index.starts, range_end)):
+        start, end, i = index.starts[pos], index.ends[pos], index.bookings[pos]
+        if end <= range_start:
+            continue
+        room = int(bookings[i][0]['resource_id'])
+        heap = running.setdefault(room, [])
+        while heap and heap[0][0] <= start:
+            heapq.heappop(heap)
+        for other_end, other in heap:
+            if other != i:
+                conflicts.append(Conflict(room=room,
+                                          start=_from_minutes(max(start, range_start)),
+                                          end=_from_minutes(min(end, other_end)),
+                                          first=other, second=i,
+                                          overlap_start=_from_minutes(start)))
+        heapq.heappush(heap, (end, i))
+    return conflicts
+
+class Recurrence:
+    """
+    Compact recurrence of a booking: dates are stored as ordinals, until as minutes.
+    Simple rules are evaluated with arithmetic on the ordinals, so only the occurrences in the requested
+    range are computed. Others use a dateutil rruleset, which is only built when needed and isn't pickled.
+    """
+    __slots__ = ('freq', 'interval', 'dtstart', 'until', 'nth_weekday', 'rdates', 'exdates', 'exwindow', '_rules')
+
+    def __init__(self, dtstart, freq=None, interval=1, until=None, nth_weekday=None):
+        self.freq = freq
+        self.interval = interval
+        self.dtstart = dtstart.toordinal()
+        self.until = _to_minutes(until) if until else None
+        # monthly by weekday: (weekday, n-th week of the month)
+        self.nth_weekday = nth_weekday
+        self.rdates = []
+        self.exdates = []
+        # (first day, last day) without occurrences, see without()
+        self.exwindow = None
+        self._rules = None
+
+    def rdate(self, day):
+        self.rdates.append(day.toordinal())
+
+    def exdate(self, day):
+        self.exdates.append(day.toordinal())
+
+    def __getstate__(self):
+        return (self.freq, self.interval, self.dtstart, self.until, self.nth_weekday, self.rdates, self.exdates,
+                self.exwindow)
+
+    def __setstate__(self, state):
+        (self.freq, self.interval, self.dtstart, self.until, self.nth_weekday, self.rdates, self.exdates,
+         self.exwindow) = state
+        self._rules = None
+
+    def without(self, first_day, last_day):
+        """Copy of the recurrence without the occurrences from first_day to last_day"""
+        other = copy.copy(self)
+        other.exwindow = (first_day.toordinal(), last_day.toordinal())
+        return other
+
+    @property
+    def rules(self):
+        if self._rules is None:
+            rules = rruleset()
+            if self.freq is not None:
+                rules.rrule(rrule(self.freq,
+                                  dtstart=_from_ordinal(self.dtstart),
+                                  until=_from_minutes(self.until) if self.until is not None else None,
+                                  interval=self.interval,
+                                  byweekday=weekday(self.nth_weekday[0])(+self.nth_weekday[1])
+                                  if self.nth_weekday else None))
+            for day in self.rdates:
+                rules.rdate(_from_ordinal(day))
+            for day in self.exdates:
+                rules.exdate(_from_ordinal(day))
+            if self.exwindow:
+                rules.exrule(rrule(DAILY, dtstart=_from_ordinal(self.exwindow[0]),
+                                   until=_from_ordinal(self.exwindow[1])))
+            self._rules = rules
+        return self._rules
+
+    def _isSimple(self):
+        """Daily, weekly, monthly and yearly rules are evaluated directly, others with dateutil"""
+        return self.freq is None or (self.freq in (DAILY, WEEKLY, MONTHLY, YEARLY) and not self.nth_weekday)
+
+    def _ruleDays(self, first, last, reverse=False):
+        """Ordinals of the occurrences of the rule from first to last, without rdates and exdates"""
+        if self.freq is None:
+            return
+        if self.until is not None:
+            last = min(last, _from_minutes(self.until).toordinal())
+        first = max(first, self.dtstart)
+        if first > last:
+            return
+        if self.freq in (DAILY, WEEKLY):
+            step = self.interval * (7 if self.freq == WEEKLY else 1)
+            k_first = -(-(first - self.dtstart) // step)
+            k_last = (last - self.dtstart) // step
+            days = range(self.dtstart + k_first * step, self.dtstart + k_last * step + 1, step)
+            yield from reversed(days) if reverse else days
+            return
+        # monthly and yearly: same day of the month every interval months, skipped if the month is too short
+        step = self.interval * (12 if self.freq == YEARLY else 1)
+        start = datetime.date.fromordinal(self.dtstart)
+        first_date, last_date = datetime.date.fromordinal(first), datetime.date.fromordinal(last)
+        month = start.year * 12 + start.month - 1
+        k_first = -(-(first_date.year * 12 + first_date.month - 1 - month) // step)
+        k_last = (last_date.year * 12 + last_date.month - 1 - month) // step
+        ks = range(k_first, k_last + 1)
+        for k in reversed(ks) if reverse else ks:
+            year, month_index = divmod(month + k * step, 12)
+            if start.day <= calendar.monthrange(year, month_index + 1)[1]:
+                day = datetime.date(year, month_index + 1, start.day).toordinal()
+                if first <= day <= last:
+                    yield day
+
+    def _isExcluded(self, day):
+        return day in self.exdates or (self.exwindow and self.exwindow[0] <= day <= self.exwindow[1])
+
+    def between(self, after, before, inc=False):
+        if not self._isSimple():
+            return self.rules.between(after, before, inc=inc)
+        # occurrences are at midnight
+        first = after.toordinal() + (0 if inc and after.time() == datetime.time(0) else 1)
+        last = before.toordinal() - (0 if inc or before.time() != datetime.time(0) else 1)
+        days = set(self._ruleDays(first, last))
+        days.update(day for day in self.rdates if first <= day <= last)
+        return [_from_ordinal(day) for day in sorted(days) if not self._isExcluded(day)]
+
+    def before(self, dt, inc=False):
+        if not self._isSimple():
+            return self.rules.before(dt, inc=inc)
+        last = dt.toordinal() - (0 if inc or dt.time() != datetime.time(0) else 1)
+        found = next((day for day in self._ruleDays(self.dtstart, last, reverse=True) if not self._isExcluded(day)),
+                     None)
+        for day in self.rdates:
+            if day <= last and (found is None or day > found) and not self._isExcluded(day):
+                found = day
+        return _from_ordinal(found) if found is not None else None
+
+    def __iter__(self):
+        return iter(self.rules)
@@ -0,0 +1,81 @@
+"""
+Compares building the OccurrenceIndex with the arithmetic of Recurrence and with dateutil rrulesets
+for generated bookings (daily, weekly, monthly, yearly and single dates, some with exdates),
+and checks that both find the same occurrences.
+
+    python -m church.occurrences_benchmark [number of bookings]
+"""
+import datetime
+import random
+import sys
+import time
+
+from dateutil.rrule import DAILY, WEEKLY, MONTHLY, YEARLY
+
+from church.config import OCCURRENCES_DAYS_BEFORE, OCCURRENCES_DAYS_AFTER
+from church.occurrences import OccurrenceIndex, Recurrence
+
+# number of times each index is built to measure the time
+_REPEAT = 3
+_FREQUENCIES = [None, DAILY, WEEKLY, WEEKLY, WEEKLY, MONTHLY, YEARLY]
+
+
+class _RruleRecurrence(Recurrence):
+    """Recurrence that always uses the dateutil rruleset"""
+    def _isSimple(self):
+        return False
+
+
+def _bookings(count, seed=0):
+    rand = random.Random(seed)
+    today = datetime.date.today()
+    bookings = []
+    for i in range(count):
+        day = today - datetime.timedelta(days=rand.randint(0, 3000))
+        start = datetime.datetime.combine(day, datetime.time(rand.randint(7, 20), rand.choice([0, 15, 30])))
+        freq = rand.choice(_FREQUENCIES)
+        rules = Recurrence(datetime.datetime.combine(day, datetime.time(0, 0)), freq, interval=rand.randint(1, 2),
+                           until=start + datetime.timedelta(days=rand.randint(30, 4000)))
+        if freq is None:
+            rules.rdate(day)
+        elif rand.random() < 0.3:
+            occurrences = rules.between(start, start + datetime.timedelta(days=4000))
+            for excluded in rand.sample(occurrences, min(len(occurrences), 3)):
+                rules.exdate(excluded)
+        bookings.append(({'id': str(i)}, rules, start, datetime.timedelta(hours=rand.randint(1, 3))))
+    return bookings
+
+
+def _withRrules(bookings):
+    rrule_bookings = []
+    for booking, rules, start, duration in bookings:
+        other = _RruleRecurrence.__new__(_RruleRecurrence)
+        other.__setstate__(rules.__getstate__())
+        rrule_bookings.append((booking, other, start, duration))
+    return rrule_bookings
+
+
+def _buildTime(bookings, first_day, last_day):
+    start = time.perf_counter()
+    for _ in range(_REPEAT):
+        index = OccurrenceIndex(bookings, first_day, last_day)
+    return (time.perf_counter() - start) / _REPEAT, index
+
+
+def benchmark(count=2000):
+    today = datetime.date.today()
+    first_day = today - datetime.timedelta(days=OCCURRENCES_DAYS_BEFORE)
+    last_day = today + datetime.timedelta(days=OCCURRENCES_DAYS_AFTER)
+    bookings = _bookings(int(count))
+    (fast_time, fast) = _buildTime(bookings, first_day, last_day)
+    (rrule_time, rrule) = _buildTime(_withRrules(bookings), first_day, last_day)
+    same = (fast.starts, fast.ends, fast.bookings) == (rrule.starts, rrule.ends, rrule.bookings)
+
+    print(f"{'Rules':<10} {'Bookings':>8} {'Occurrences':>11} {'Build ms':>9}")
+    print(f"{'Recurrence':<10} {len(bookings):>8} {len(fast.starts):>11} {fast_time * 1000:>9.1f}")
+    print(f"{'rruleset':<10} {len(bookings):>8} {len(rrule.starts):>11} {rrule_time * 1000:>9.1f}")
+    print(f"Speedup: {rrule_time / fast_time:.1f}x, same occurrences: {'yes' if same else 'NO'}")
+
+
+if __name__ == '__main__':
+    benchmark(*sys.argv[1:])
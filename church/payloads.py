@@ -0,0 +1,109 @@
+"""
+Content-addressed store for cached responses: a body is stored once under its hash (payload:<hash>)
+and cache keys only contain the hash, so identical responses for many persons take the space of one.
+Each body lists the keys referencing it in payload:<hash>:refs (score: expiry of the key),
+it's removed as soon as the last key is overwritten, deleted or expired.
+"""
+import hashlib
+import time
+
+from church import redis
+
+_PREFIX = 'payload:'
+_HASH_LENGTH = 40
+
+# the body lives as long as the key referencing it that expires last, ARGV[1]: prefix, ARGV[2]: now
+_RELEASE = '''
+local function expire(body, refs)
+    if redis.call('ZCOUNT', refs, '+inf', '+inf') > 0 then
+        redis.call('PERSIST', body)
+        redis.call('PERSIST', refs)
+    else
+        local expires = math.ceil(tonumber(redis.call('ZRANGE', refs, -1, -1, 'WITHSCORES')[2]))
+        redis.call('EXPIREAT', body, expires)
+        redis.call('EXPIREAT', refs, expires)
+    end
+end
+
+-- removes key from the references of its current body
+local function release(key, prefix, now)
+    local old = redis.call('GET', key)
+    if not old or #old ~= %d then
+        return old
+    end
+    local refs = prefix .. old .. ':refs'
+    redis.call('ZREM', refs, key)
+    redis.call('ZREMRANGEBYSCORE', refs, '-inf', now)
+    if redis.call('ZCARD', refs) == 0 then
+        redis.call('DEL', refs, prefix .. old)
+    else
+        expire(prefix .. old, refs)
+    end
+    return old
+end
+''' % _HASH_LENGTH
+
+# ARGV[3]: hash, ARGV[4]: body, ARGV[5]: expiry in seconds (0 for none)
+_store_script = redis.register_script(_RELEASE + '''
+local key, prefix, now, digest, ex = KEYS[1], ARGV[1], tonumber(ARGV[2]), ARGV[3], tonumber(ARGV[5])
+if redis.call('GET', key) ~= digest then
+    release(key, prefix, now)
+end
+local body = prefix .. digest
+local refs = body .. ':refs'
+if redis.call('EXISTS', body) == 0 then
+    redis.call('SET', body, ARGV[4])
+end
+if ex > 0 then
+    redis.call('ZADD', refs, now + ex, key)
+    redis.call('SET', key, digest, 'EX', ex)
+else
+    redis.call('ZADD', refs, '+inf', key)
+    redis.call('SET', key, digest)
+end
+expire(body, refs)
+''')
+
+_delete_script = redis.register_script(_RELEASE + '''
+release(KEYS[1], ARGV[1], tonumber(ARGV[2]))
+redis.call('DEL', KEYS[1])
+''')
+
+# bodies of the keys, keys written before the store existed still contain the body itself
+_load_script = redis.register_script('''
+local bodies = {}
+for i, key in ipairs(KEYS) do
+    local value = redis.call('GET', key)
+    if value and #value == %d then
+        value = redis.call('GET', ARGV[1] .. value)
+    end
+    bodies[i] = value
+end
+return bodies
+''' % _HASH_LENGTH)
+
+
+def payloadHash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def storePayload(key, body, ex=None):
+    """Lets key point to body (bytes) and returns the hash of body"""
+    digest = payloadHash(body)
+    _store_script(keys=[key], args=[_PREFIX, time.time(), digest, body, int(ex or 0)])
+    return digest
+
+
+def loadPayloads(keys):
+    """Bodies the keys point to, None for missing keys"""
+    if not keys:
+        return []
+    return _load_script(keys=keys, args=[_PREFIX])
+
+
+def loadPayload(key):
+    return loadPayloads([key])[0]
+
+
+def deletePayload(key):
+    _delete_script(keys=[key], args=[_PREFIX, time.time()])
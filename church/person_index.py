@@ -0,0 +1,211 @@
+import unicodedata
+
+from church.ChurchToolsRequests import getCacheVersion
+from church.utils import loadIndex
+
+_umlauts = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'})
+_NAME, _VORNAME, _SPITZNAME = range(3)
+# all substrings up to this length are indexed, longer search terms are split into them
+_GRAM_LENGTH = 3
+# fuzzy search: max. number of results
+_FUZZY_LIMIT = 10
+
+
+def fold(text):
+    """Lowercase, umlauts replaced (ü -> ue) and other accents removed"""
+    text = (text or '').lower().translate(_umlauts)
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+
+def _max_distance(term):
+    """Number of typos allowed in a search term for the fuzzy search"""
+    return 1 if len(term) <= 5 else 2
+
+
+def levenshtein(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def cologne_phonetics(text):
+    """Kölner Phonetik of a folded text, e.g. meier and maier -> 67"""
+    text = ''.join(c for c in text.upper() if 'A' <= c <= 'Z')
+    codes = []
+    for i, c in enumerate(text):
+        prev = text[i - 1] if i > 0 else ''
+        next = text[i + 1] if i + 1 < len(text) else ''
+        if c in 'AEIJOUY':
+            code = '0'
+        elif c == 'H':
+            code = ''
+        elif c == 'B':
+            code = '1'
+        elif c == 'P':
+            code = '3' if next == 'H' else '1'
+        elif c in 'DT':
+            code = '8' if next in ('C', 'S', 'Z') else '2'
+        elif c in 'FVW':
+            code = '3'
+        elif c in 'GKQ':
+            code = '4'
+        elif c == 'C':
+            if i == 0:
+                code = '4' if next in ('A', 'H', 'K', 'L', 'O', 'Q', 'R', 'U', 'X') else '8'
+            else:
+                code = '4' if next in ('A', 'H', 'K', 'O', 'Q', 'U', 'X') and prev not in ('S', 'Z') else '8'
+        elif c == 'X':
+            code = '8' if prev in ('C', 'K', 'Q') else '48'
+        elif c == 'L':
+            code = '5'
+        elif c in 'MN':
+            code = '6'
+        elif c == 'R':
+            code = '7'
+        else:  # S, Z
+            code = '8'
+        codes.append(code)
+    collapsed = ''
+    for code in ''.join(codes):
+        if not collapsed or collapsed[-1] != code:
+            collapsed += code
+    return collapsed[:1] + collapsed[1:].replace('0', '')
+
+
+class BKTree:
+    """BK-tree over the edit distance, each node is [word, {distance: child node}]"""
+    def __init__(self, words):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = [word, {}]
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            if distance not in node[1]:
+                node[1][distance] = [word, {}]
+                return
+            node = node[1][distance]
+
+    def search(self, word, max_distance):
+        """(distance, word) of all words within max_distance"""
+        found = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            distance = levenshtein(word, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[0]))
+            nodes += [child for d, child in node[1].items()
+                      if distance - max_distance <= d <= distance + max_distance]
+        return found
+
+
+def _grams(text):
+    return {text[i:i + n] for n in range(1, _GRAM_LENGTH + 1) for i in range(len(text) - n + 1)}
+
+
+class PersonIndex:
+    """
+    Name index over getAllPersonData.
+    exact maps whole (folded) names to the keys of the persons, grams maps substrings of the
+    last and first names to the keys of the persons.
+    tree and phonetic are used for the fuzzy search.
+    """
+    # increase when the structure changes, so indexes stored by older versions are rebuilt
+    FORMAT = 2
+
+    def __init__(self, persons):
+        self.names = {}
+        self.exact = {}
+        self.grams = ({}, {})
+        for n, person in persons.items():
+            if not person:
+                continue
+            names = tuple(fold(person.get(k)) for k in ['name', 'vorname', 'spitzname'])
+            self.names[n] = names
+            for name in names:
+                self.exact.setdefault(name, set()).add(n)
+            for field in [_NAME, _VORNAME]:
+                for gram in _grams(names[field]):
+                    self.grams[field].setdefault(gram, set()).add(n)
+        names = [name for name in self.exact if name]
+        self.tree = BKTree(names)
+        self.phonetic = {}
+        for name in names:
+            self.phonetic.setdefault(cologne_phonetics(name), set()).add(name)
+
+    def _containing(self, field, part):
+        """Keys of persons whose name field contains part"""
+        if not part:
+            return set(self.names)
+        if len(part) <= _GRAM_LENGTH:
+            return self.grams[field].get(part, set())
+        candidates = None
+        for gram in {part[i:i + _GRAM_LENGTH] for i in range(len(part) - _GRAM_LENGTH + 1)}:
+            found = self.grams[field].get(gram, set())
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return set()
+        return {n for n in candidates if part in self.names[n][field]}
+
+    def search(self, text):
+        """
+        Keys of persons where each search term is one of their names or,
+        with two or more terms, the first two are part of their last and first name.
+        """
+        parts = [fold(t) for t in text.split(' ')]
+        matches = set.intersection(*[self.exact.get(p, set()) for p in parts])
+        if len(parts) > 1:
+            matches = matches | \
+                      self._containing(_NAME, parts[0]) & self._containing(_VORNAME, parts[1]) | \
+                      self._containing(_NAME, parts[1]) & self._containing(_VORNAME, parts[0]) | \
+                      self._containing(_NAME, parts[1]) & self._containing(_NAME, parts[0])
+        return matches
+
+    def fuzzySearch(self, text, limit=_FUZZY_LIMIT):
+        """
+        Keys of persons where each search term is similar to one of their names,
+        i.e. it has few typos or sounds the same. Sorted by the number of typos.
+        """
+        scores = None
+        for part in [fold(t) for t in text.split(' ') if t]:
+            names = {name: distance for distance, name in self.tree.search(part, _max_distance(part))}
+            for name in self.phonetic.get(cologne_phonetics(part), set()):
+                if name not in names:
+                    names[name] = levenshtein(part, name)
+            part_scores = {}
+            for name, distance in names.items():
+                for n in self.exact[name]:
+                    part_scores[n] = min(distance, part_scores.get(n, distance))
+            if scores is None:
+                scores = part_scores
+            else:
+                scores = {n: score + part_scores[n] for n, score in scores.items() if n in part_scores}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        return sorted(scores, key=lambda n: (scores[n], self.names[n]))[:limit]
+
+
+def getPersonIndex(login_data, version, persons):
+    if version:
+        version = f'{version}:{PersonIndex.FORMAT}'
+    return loadIndex(login_data, 'person_index', version, lambda: PersonIndex(persons))
+
+
+def getPersonDataVersion(login_data):
+    return getCacheVersion("db", "getAllPersonData", login_data=login_data)
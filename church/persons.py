@@ -2,39 +2,24 @@ import logging
 import re
 import traceback
 from datetime import datetime
-from io import BytesIO
 from urllib.parse import urljoin
 
 import phonenumbers
-import requests
 import telegram
 import vobject
 from telegram import Contact
 
-from church.ChurchToolsRequests import getAjaxResponse, logger, getPersonLink
+from church import media
+from church.ChurchToolsRequests import getAjaxResponse, getAjaxResponses, logger, getPersonLink, DAILY_DATA
+from church.master_data import getMasterData, getBlockData, getGroupSignupInfos
+from church.person_index import getPersonIndex, getPersonDataVersion
+from church.phone_index import parseNumber, updatePhoneIndex, findByNumber
+from church.sessions import get_session, get_timeout
 from church.utils import send_message, pi_notice
 
 logger = logging.getLogger(__name__)
 
 
-def _parseNumber(num):
-    if num:
-        try:
-            num = num.replace(' ', '').replace('/', '').replace('-', '')
-            if num:
-                num = phonenumbers.parse(num, region='DE')
-                num_type = phonenumbers.number_type(num)
-                if phonenumbers.is_valid_number(num) and num_type in [
-                    phonenumbers.PhoneNumberType.FIXED_LINE,
-                    phonenumbers.PhoneNumberType.PERSONAL_NUMBER,
-                    phonenumbers.PhoneNumberType.MOBILE,
-                    phonenumbers.PhoneNumberType.FIXED_LINE_OR_MOBILE]:
-                    return phonenumbers.format_number(num, phonenumbers.PhoneNumberFormat.E164)
-        except phonenumbers.NumberParseException as e:
-            logger.warning(f'Number "{num}" caused an exception: ' + str(e))
-    return None
-
-
 _keyNameMap = {
     'telefonhandy': 'Handy',
     'telefonprivat': 'Privat',
@@ -48,6 +33,12 @@ _all2detail = {
 }
 
 
+def getPersonDetails(login_data, ids):
+    """getPersonDetails for several persons, returns the first error and a dict of id -> details"""
+    return getAjaxResponses("db", "getPersonDetails", login_data=login_data, timeout=24 * 3600,
+                            paramName='id', values=ids)
+
+
 def _printPerson(login_data, p, extraData=None, personList=False, onlyName=False, additionalName=''):
     groups = p['groupmembers'] if 'groupmembers' in p else None
     if extraData is None and (type(p) is str or not personList and not onlyName):
@@ -100,12 +91,10 @@ def _printPerson(login_data, p, extraData=None, personList=False, onlyName=False
     # Relatives
     if 'rels' in p and p['rels']:
         t += '<pre>Verwandschaft</pre>\n'
-        for rel in p['rels']:
-            rel_id = rel['vater_id'] if rel['vater_id'] != p['id'] else rel['kind_id']
-            (error, rel_person) = getAjaxResponse("db", "getPersonDetails",
-                                                  login_data=login_data,
-                                                  timeout=24 * 3600,
-                                                  id=rel_id)
+        rel_ids = [rel['vater_id'] if rel['vater_id'] != p['id'] else rel['kind_id'] for rel in p['rels']]
+        (error, rel_persons) = getPersonDetails(login_data, rel_ids)
+        for rel, rel_id in zip(p['rels'], rel_ids):
+            rel_person = rel_persons.get(rel_id)
             if rel_person:
                 rel_name = f'{rel_person["vorname"]} {rel_person["name"]}'
             elif 'name' in rel:
@@ -164,14 +153,9 @@ def printPersonGroups(login_data, person):
     if not groups:
         t += '<i>Keine Gruppen gefunden.</i>'
         return t
-    (error, master_data) = getAjaxResponse("db", "getMasterData", login_data=login_data, timeout=None)
-    (error, block_data) = getAjaxResponse('home', 'getBlockData', login_data=login_data, timeout=None)
-    group_signup_infos = None
-    try:
-        if block_data:
-            group_signup_infos = block_data['blocks']['managemymembership']['data']['chosable']
-    except:
-        pass
+    (error, master_data) = getMasterData(login_data)
+    (error, block_data) = getBlockData(login_data)
+    group_signup_infos = getGroupSignupInfos(block_data)
     if master_data:
         group_types = {}
         for group_id in groups:
@@ -214,10 +198,11 @@ def _personGroupAdditionalInfo(group_id, person_id, group_signup_infos):
     return answer_kv
 
 
-def _printPersons(login_data, ps, include_pi=False):
+def _printPersons(login_data, ps, include_pi=False, sort=True):
     texts = []
-    ps = sorted(ps, key=lambda p: p['vorname'])
-    ps = sorted(ps, key=lambda p: p['name'])
+    if sort:
+        ps = sorted(ps, key=lambda p: p['vorname'])
+        ps = sorted(ps, key=lambda p: p['name'])
     if include_pi:
         use_list = len(ps) > 1
         use_name = len(ps) > 5
@@ -229,7 +214,7 @@ def _printPersons(login_data, ps, include_pi=False):
     return '\n\n'.join(texts)
 
 
-def _getContact(p, photo_raw):
+def _getContact(p, photo):
     j = vobject.vCard()
     phone = None
     if 'telefonprivat' in p and p['telefonprivat']:
@@ -254,45 +239,48 @@ def _getContact(p, photo_raw):
         email.value = p['em']
         email.type_param = 'INTERNET'
 
-    # if photo_raw:
+    # if photo:
     #     attr = j.add('photo')
     #     attr.type_param = 'jpeg'
     #     attr.encoding_param = 'b'
-    #     attr.value = photo_raw
+    #     attr.value = photo
     # -> Is "rate limited" because it's too large :(
 
     # return Contact(first_name=first_name, last_name=last_name, phone_number=_parseNumber(phone)) #, vcard=j.serialize())
 
     # add 'vcard': j.serialize() when the rate-limiting bug is fixed..
     return {
-        'phone_number': str(_parseNumber(phone)),
+        'phone_number': str(parseNumber(phone)),
         'first_name': first_name,
         'last_name': last_name
     }
 
 
+def _downloadPhoto(login_data, url):
+    try:
+        r = get_session(login_data).get(url, timeout=get_timeout('photo'))
+        if r.ok:
+            # p = j.add('photo')
+            # p.type_param = 'JPEG'
+            # p.encoding_param = 'b'
+            # p.value = r.content
+            # p.value = f'https://feg-karlsruhe.de/intern/?q=public/filedownload&filename={img_id}&type=image'
+            photo = r.content
+            r.close()
+            return photo
+        else:
+            return None
+    except Exception as e:
+        logger.warning('Couldn\'t download photo: ' + str(e))
+        return None
+
+
 def _getPhoto(login_data, extraData):
-    photo = None
     if 'imageurl' in extraData and extraData['imageurl']:
         img_id = extraData['imageurl']
         url = urljoin(login_data['url'], f'?q=public/filedownload&filename={img_id}&type=image')
         # return (url, None)
-        try:
-            r = requests.get(url)
-            if r.ok:
-                # p = j.add('photo')
-                # p.type_param = 'JPEG'
-                # p.encoding_param = 'b'
-                # p.value = r.content
-                # p.value = f'https://feg-karlsruhe.de/intern/?q=public/filedownload&filename={img_id}&type=image'
-                photo = r.content
-                r.close()
-                return url, photo
-            else:
-                return url, None
-        except Exception as e:
-            logger.warning('Couldn\'t download photo: ' + str(e))
-            return url, None
+        return url, media.getFileId(url) or _downloadPhoto(login_data, url)
     return None, None
 
 
@@ -307,22 +295,24 @@ def _getPersonInfo(login_data, person, include_pi=False, extraData=None):
                                              id=person['p_id'])
     res = {'msg': _printPerson(login_data, person, extraData=extraData)}
 
-    photo_raw = None
+    photo = None
     if extraData:
-        photo_url, photo_raw = _getPhoto(login_data, extraData)
+        photo_url, photo = _getPhoto(login_data, extraData)
         if photo_url:
             res['photo_url'] = photo_url
-        if photo_raw:
-            res['photo_raw'] = photo_raw
+        if photo:
+            res['photo'] = photo
 
-    contact = _getContact(person, photo_raw)
+    contact = _getContact(person, photo)
     if contact:
         res['contact'] = contact
     return res
 
 
 def searchPerson(login_data, text, include_pi=False):
-    (error, data) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, timeout=24 * 3600)
+    (error, data) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, stale=DAILY_DATA)
+    # read after the fetch, so it belongs to data unless the data is refreshed in between
+    version = getPersonDataVersion(login_data)
 
     regex_id = '/(P|C|PG)([0-9]+)'
     regex_phone = '\+?[0-9 /()-]+'
@@ -334,38 +324,22 @@ def searchPerson(login_data, text, include_pi=False):
     elif re.match(regex_id, text):
         pid = re.match(regex_id, text).group(2)
         logger.debug(f"Searching for id {pid}")
-        for n in data:
-            person = data[n]
-            if not person:
-                continue
-            if person['p_id'] == pid:
-                logger.debug("Found it!")
-                res = _getPersonInfo(login_data, person, include_pi=include_pi)
-                if error:
-                    res['msg'] += f'\n<i>{error}</i>'
-                return res
+        person = data.get(pid)
+        if person and person['p_id'] == pid:
+            logger.debug("Found it!")
+            res = _getPersonInfo(login_data, person, include_pi=include_pi)
+            if error:
+                res['msg'] += f'\n<i>{error}</i>'
+            return res
 
     elif re.match(regex_phone, text):
         logger.debug(f"Searching through {len(data)} persons..")
         try:
-            cur = _parseNumber(text)
+            cur = parseNumber(text)
             if cur:
-                matches = []
-                for n in data:
-                    person = data[n]
-                    if not person:
-                        continue
-                    privat = _parseNumber(person['telefonprivat'])
-                    handy = _parseNumber(person['telefonhandy'])
-                    geschäftlich = _parseNumber(person['telefongeschaeftlich']) \
-                        if 'telefongeschaeftlich' in person else None
-                    if (privat and privat == cur) or \
-                            (handy and handy == cur) or \
-                            (geschäftlich and geschäftlich == cur):
-                        logger.debug(f"Found: {person}")
-                        matches.append(person)
-                    # elif handy:
-                    #    logger.info(f"Not {person['vorname']} {person['name']}: {handy}")
+                updatePhoneIndex(login_data, version, data)
+                matches = [data[n] for n in findByNumber(login_data, cur) if n in data]
+                logger.debug(f"Found: {matches}")
                 if len(matches) == 1:
                     return _getPersonInfo(login_data, matches[0], include_pi=include_pi)
                 elif len(matches) > 1:
@@ -391,26 +365,13 @@ def searchPerson(login_data, text, include_pi=False):
         'success': False,
         'msg': f'Niemand gefunden mit dem Namen "{text}" :('
     }
-    searchNameParts = [t.lower() for t in text.split(' ')]
-    fullMatches = []
-    for n in data:
-        person = data[n]
-        if not person:
-            continue
-        nameParts = [person['name'].lower(), person['vorname'].lower(), person['spitzname'].lower()]
-        if all(s in nameParts for s in searchNameParts):
-            logger.debug(f"Found full match: {person}")
-            fullMatches.append(person)
-        elif len(searchNameParts) > 1 and (
-                searchNameParts[0] in nameParts[0] and searchNameParts[1] in nameParts[1] or
-                searchNameParts[1] in nameParts[0] and searchNameParts[0] in nameParts[0]):
-            fullMatches.append(person)
-        # elif any(s in p for p in nameParts for s in searchNameParts):
-        #    logger.debug(f"Found partial match: {person}")
-        #    partialMatches.append(person)
-        if len(fullMatches) > 50:
-            res['msg'] = f"Found more then 50 people. Please refine your search phrase"
-            return res
+    index = getPersonIndex(login_data, version, data)
+    # the index may belong to another version of the data, if it was refreshed in the meantime
+    fullMatches = [data[n] for n in index.search(text) if n in data]
+    similar = [data[n] for n in index.fuzzySearch(text) if n in data] if not fullMatches else []
+    if len(fullMatches) > 50:
+        res['msg'] = f"Found more then 50 people. Please refine your search phrase"
+        return res
 
     if fullMatches:
         res['success'] = True
@@ -422,19 +383,23 @@ def searchPerson(login_data, text, include_pi=False):
                                                     login_data=login_data, timeout=24 * 3600,
                                                     id=p_id)
                 if extraData:
-                    photo_url, photo_raw = _getPhoto(login_data=login_data, extraData=extraData)
+                    photo_url, photo = _getPhoto(login_data=login_data, extraData=extraData)
                     if photo_url:
                         res['photo_url'] = photo_url
-                    if photo_raw:
-                        res['photo_raw'] = photo_raw
+                    if photo:
+                        res['photo'] = photo
 
-                contact = _getContact(fullMatches[0], photo_raw)
+                contact = _getContact(fullMatches[0], photo)
                 if contact:
                     res['contact'] = contact
             res.update(_getPersonInfo(login_data, fullMatches[0], include_pi=include_pi, extraData=extraData))
             res['success'] = True
         else:
             res['msg'] = _printPersons(login_data, fullMatches, include_pi=include_pi)
+    elif similar:
+        res['success'] = True
+        res['msg'] = '<i>Ähnliche Namen:</i>\n\n' + _printPersons(login_data, similar, include_pi=include_pi,
+                                                                    sort=False)
     else:
         (error, data) = getAjaxResponse(f'search?query={text}', login_data=login_data, isAjax=False,
                                         timeout=24 * 3600)
@@ -454,12 +419,12 @@ def searchPerson(login_data, text, include_pi=False):
                     (error, data) = getAjaxResponse("db", "getPersonDetails", login_data=login_data, timeout=24 * 3600,
                                                     id=p_id)
                     if data:
-                        photo_url, photo_raw = _getPhoto(login_data=login_data, extraData=data)
+                        photo_url, photo = _getPhoto(login_data=login_data, extraData=data)
                         if photo_url:
                             res['photo_url'] = photo_url
-                        if photo_raw:
-                            res['photo_raw'] = photo_raw
-                        contact = _getContact(data, photo_raw)
+                        if photo:
+                            res['photo'] = photo
+                        contact = _getContact(data, photo)
                         if contact:
                             res['contact'] = contact
                     res['msg'] = _printPerson(login_data, p_id, personList=False, onlyName=False)
@@ -471,8 +436,10 @@ def searchPerson(login_data, text, include_pi=False):
                 if include_pi:
                     use_list = len(matches) > 1
                     use_name = len(matches) > 5
+                (details_error, details) = getPersonDetails(login_data, matches)
                 for p_id in matches:
-                    texts.append(_printPerson(login_data, p_id, personList=use_list, onlyName=use_name))
+                    texts.append(_printPerson(login_data, p_id, extraData=details.get(p_id),
+                                              personList=use_list, onlyName=use_name))
                 res['msg'] = '\n\n'.join(texts)
 
     # elif partialMatches:
@@ -482,13 +449,13 @@ def searchPerson(login_data, text, include_pi=False):
     #                                             login_data=login_data, timeout=24 * 3600,
     #                                             id=fullMatches[0]['p_id'])
     #        if extraData:
-    #            photo_url, photo_raw = _getPhoto(login_data, partialMatches[0], extraData)
+    #            photo_url, photo = _getPhoto(login_data, partialMatches[0], extraData)
     #            if photo_url:
     #                res['photo_url'] = photo_url
-    #            if photo_raw:
-    #                res['photo_raw'] = photo_raw
+    #            if photo:
+    #                res['photo'] = photo
 
-    #        contact = _getContact(p=partialMatches[0], photo_raw=photo_raw)
+    #        contact = _getContact(p=partialMatches[0], photo=photo)
     #        if contact:
     #            res['contact'] = contact
     #        res.update(_getPersonInfo(login_data, partialMatches[0], extraData=extraData))
@@ -506,11 +473,12 @@ def person(context, update, text, reply_markup, login_data, include_pi=False, co
         if contact and 'contact' in res:
             context.bot.send_contact(update.effective_chat.id, **res['contact'], reply_markup=reply_markup)
         else:
-            if 'photo_raw' in res:
+            if 'photo' in res:
                 try:
-                    context.bot.send_photo(update.effective_chat.id, photo=BytesIO(res['photo_raw']),
-                                           caption=res['msg'],
-                                           parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup, timeout=30)
+                    media.sendPhoto(context.bot, update.effective_chat.id, res['photo_url'], res['photo'],
+                                    lambda: _downloadPhoto(login_data, res['photo_url']),
+                                    caption=res['msg'],
+                                    parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup, timeout=30)
                 except Exception as e:
                     res[
                         'msg'] += f'\n<i>Couldn\'t send photo :(\nYou can open it </i><a href="{res["photo_url"]}">here</a>.'
@@ -0,0 +1,88 @@
+import json
+import logging
+
+import phonenumbers
+
+from church import redis
+from church.utils import get_cache_key
+
+logger = logging.getLogger(__name__)
+
+_phone_fields = ['telefonprivat', 'telefonhandy', 'telefongeschaeftlich']
+
+
+def parseNumber(num):
+    if num:
+        try:
+            num = num.replace(' ', '').replace('/', '').replace('-', '')
+            if num:
+                num = phonenumbers.parse(num, region='DE')
+                num_type = phonenumbers.number_type(num)
+                if phonenumbers.is_valid_number(num) and num_type in [
+                    phonenumbers.PhoneNumberType.FIXED_LINE,
+                    phonenumbers.PhoneNumberType.PERSONAL_NUMBER,
+                    phonenumbers.PhoneNumberType.MOBILE,
+                    phonenumbers.PhoneNumberType.FIXED_LINE_OR_MOBILE]:
+                    return phonenumbers.format_number(num, phonenumbers.PhoneNumberFormat.E164)
+        except phonenumbers.NumberParseException as e:
+            logger.warning(f'Number "{num}" caused an exception: ' + str(e))
+    return None
+
+
+def _get_keys(login_data):
+    # index: E.164 number -> person ids, numbers: person id -> raw and parsed numbers
+    return (get_cache_key(login_data, 'phone_index'),
+            get_cache_key(login_data, 'phone_index:numbers'),
+            get_cache_key(login_data, 'phone_index:version'))
+
+
+def updatePhoneIndex(login_data, version, persons):
+    """
+    Updates the number index to the given version of getAllPersonData.
+    Only numbers that changed since the last version are parsed again.
+    """
+    index_key, numbers_key, version_key = _get_keys(login_data)
+    if version and redis.get(version_key) == version.encode('utf-8'):
+        return
+    old_numbers = {k.decode('utf-8'): json.loads(v) for k, v in redis.hgetall(numbers_key).items()}
+    numbers = {}
+    changed = {}
+    for n, person in persons.items():
+        if not person:
+            continue
+        raw = [person.get(field) or '' for field in _phone_fields]
+        entry = old_numbers.get(n)
+        if not entry or entry['raw'] != raw:
+            entry = {
+                'raw': raw,
+                'e164': sorted({num for num in map(parseNumber, raw) if num}),
+            }
+            changed[n] = json.dumps(entry)
+        numbers[n] = entry
+    removed = [n for n in old_numbers if n not in numbers]
+    logger.info(f"Phone index: {len(changed)} changed, {len(removed)} removed")
+
+    index = {}
+    for n, entry in numbers.items():
+        for num in entry['e164']:
+            index.setdefault(num, []).append(n)
+
+    pipe = redis.pipeline()
+    pipe.delete(index_key)
+    if index:
+        pipe.hset(index_key, mapping={num: json.dumps(ids) for num, ids in index.items()})
+    if changed:
+        pipe.hset(numbers_key, mapping=changed)
+    if removed:
+        pipe.hdel(numbers_key, *removed)
+    if version:
+        pipe.set(version_key, version)
+    pipe.execute()
+
+
+def findByNumber(login_data, number):
+    """Ids of the persons with the given E.164 number"""
+    index_key, _, _ = _get_keys(login_data)
+    # HMGET instead of HGET, which is parsed as json even if the field doesn't exist
+    ids = redis.hmget(index_key, [number])[0]
+    return json.loads(ids) if ids else []
@@ -6,6 +6,8 @@ from urllib.parse import urljoin
 
 from church import ChurchToolsRequests
 from church.RoomBookingParser import RoomBookingParser
+from church.digests import getDigest
+from church.master_data import getRooms
 
 logger = ChurchToolsRequests.logging.getLogger(__name__)
 
@@ -14,6 +16,12 @@ room_markup = ['Alle',
                'Nebenräume',
                'Rest']
 
+_weekdays = ['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So']
+_slot_re = re.compile(r'^\s*(?:(?P<day>\S+)\s+)?(?P<start>\d{1,2}(?::\d{2})?)\s*(?:uhr)?\s*-\s*'
+                      r'(?P<end>\d{1,2}(?::\d{2})?)\s*(?:uhr)?\s*$', re.IGNORECASE)
+_date_re = re.compile(r'^(\d{1,2})\.(\d{1,2})\.(\d{2}|\d{4})?$')
+
+
 def _get_day_link(login_data, date):
     return urljoin(login_data['url'], f'?q=churchresource&curdate={date:%Y-%m-%d}')
 
@@ -94,11 +102,17 @@ def parseRaeumeByText(login_data, search):
         text[-1] = text[-1] + f'\n<i>{error}</i>'
     return text
 
-def parseRaeumeByTime(login_data, subset=None, dayRange=7, dayOffset=0):
+def parseRaeumeByTime(login_data, subset=None, dayRange=7, dayOffset=0, updateDigest=False):
     parser = RoomBookingParser(login_data)
+    return getDigest(login_data, f'rooms:{subset}:{dayRange}:{dayOffset}',
+                     lambda: _renderRaeumeByTime(login_data, parser, subset, dayRange, dayOffset),
+                     parser=parser, update=updateDigest)
+
+
+def _renderRaeumeByTime(login_data, parser, subset, dayRange, dayOffset):
     error, entr = parser.getEntries(dayRange, dayOffset, subset=subset, sortByRoom=dayRange == 0)
     if entr is None:
-        return ["Konnte Daten nicht abrufen!"]
+        return error, ["Konnte Daten nicht abrufen!"]
 
     logger.debug(error)
     logger.debug(entr)
@@ -111,5 +125,101 @@ def parseRaeumeByTime(login_data, subset=None, dayRange=7, dayOffset=0):
         text[0] = f"<b>{subset}</b>\n" + text[0]
     if error:
         text[-1] = text[-1] + f'\n<i>{error}</i>'
-    return text
-
+    return error, text
+
+
+def _parse_day(text, today):
+    if not text or text.lower() == 'heute':
+        return today
+    text = text.lower().rstrip(',')
+    if text == 'morgen':
+        return today + timedelta(days=1)
+    if text == 'übermorgen':
+        return today + timedelta(days=2)
+    for i, name in enumerate(_weekdays):
+        if text.startswith(name.lower()):
+            return today + timedelta(days=(i - today.weekday()) % 7)
+    m = _date_re.match(text)
+    if m:
+        day, month, year = m.groups()
+        year = int(year) if year else today.year
+        if year < 100:
+            year += 2000
+        try:
+            date = datetime(year, int(month), int(day)).date()
+        except ValueError:
+            return None
+        if not m.group(3) and date < today:
+            date = date.replace(year=date.year + 1)
+        return date
+    return None
+
+
+def _parse_time(text):
+    hour, _, minute = text.partition(':')
+    if int(hour) > 23 or (minute and int(minute) > 59):
+        return None
+    return time(int(hour), int(minute) if minute else 0)
+
+
+def parseSlot(text, today=None):
+    """
+    Parses a time slot like "So 14-16", "morgen 9:30-12 Uhr" or "24.12. 18:00-20:00" into (start, end).
+    Without a day the slot is today, weekdays refer to the next such day.
+    """
+    m = _slot_re.match(text)
+    if not m:
+        return None
+    day = _parse_day(m.group('day'), today or datetime.now().date())
+    start = _parse_time(m.group('start'))
+    end = _parse_time(m.group('end'))
+    if not day or not start or not end or end <= start:
+        return None
+    return datetime.combine(day, start), datetime.combine(day, end)
+
+
+def _format_slot(start, end):
+    return f"{_weekdays[start.weekday()]}, {start:%d.%m.} {start:%H:%M}-{end:%H:%M}"
+
+
+def _slot_command(room, start, end):
+    return f"/F{room}_{start:%Y%m%d%H%M}_{int((end - start).total_seconds()) // 60}"
+
+
+def parseFreieRaeume(login_data, text):
+    slot = parseSlot(text)
+    if not slot:
+        return ["Zeitraum nicht erkannt, z.B. <code>So 14-16</code> oder <code>24.12. 18:00-20:00</code>"]
+    start, end = slot
+    error, rooms = getRooms(login_data)
+    if not rooms:
+        return ["Konnte Räume nicht abrufen!\n" + (error or '')]
+    error, availability = RoomBookingParser(login_data).getAvailability()
+    if not availability:
+        return ["Konnte Daten nicht abrufen!\n" + (error or '')]
+    if not availability.covers(start, end):
+        return [f"Buchungen sind nur bis {availability.last_day:%d.%m.%Y} bekannt."]
+
+    free = set(availability.freeRooms([r for r, name in rooms], start, end))
+    text = f"<b>Freie Räume</b> {_format_slot(start, end)}\n"
+    text += ''.join(f"{name}\n" for r, name in rooms if r in free) or "<i>Keine</i>\n"
+    busy = [(r, name) for r, name in rooms if r not in free]
+    if busy:
+        text += "\n<i>Belegt (nächster freier Termin):</i>\n"
+        text += ''.join(f"{name} {_slot_command(r, start, end)}\n" for r, name in busy)
+    if error:
+        text += f'\n<i>{error}</i>'
+    return [text]
+
+
+def parseNaechsterFreierTermin(login_data, room, start, minutes):
+    error, rooms = getRooms(login_data)
+    name = dict(rooms).get(room, f'Raum {room}') if rooms else f'Raum {room}'
+    error, availability = RoomBookingParser(login_data).getAvailability()
+    if not availability:
+        return ["Konnte Daten nicht abrufen!\n" + (error or '')]
+    duration = timedelta(minutes=minutes)
+    free = availability.nextFreeSlot(room, max(start, datetime.now()), duration)
+    if not free:
+        return [f"<b>{name}</b> ist bis {availability.last_day:%d.%m.%Y} nicht mehr frei."]
+    return [f"Nächster freier Termin für <b>{name}</b>:\n{_format_slot(free, free + duration)}"]
@@ -0,0 +1,49 @@
+import logging
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from church.config import HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class _NoCookiesPolicy(DefaultCookiePolicy):
+    # The session is shared by all users of an instance, so it must never keep cookies itself.
+    # Cookies are always passed per request and read from the response.
+    def set_ok(self, cookie, request):
+        return False
+
+
+def _create_session():
+    session = requests.Session()
+    session.cookies.set_policy(_NoCookiesPolicy())
+    retries = Retry(total=HTTP_RETRIES, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, pool_block=True, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(login_data):
+    url = login_data['url']
+    session = _sessions.get(url)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(url)
+            if session is None:
+                logger.info(f"Creating HTTP session for {url}")
+                session = _create_session()
+                _sessions[url] = session
+    return session
+
+
+def get_timeout(endpoint):
+    return HTTP_TIMEOUTS.get(endpoint, HTTP_TIMEOUTS['default'])
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from redis.exceptions import LockError
+
+from church import redis
+from church.config import SINGLE_FLIGHT_WAIT_TIMEOUT, SINGLE_FLIGHT_LOCK_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(key, fetch, load, refresh=False):
+    """
+    Makes sure only one fetch() runs per cache key at a time.
+    Callers in the same process share the result of the running fetch, other bot instances wait for the
+    redis lock to be released and call load() to read the result from the cache.
+    fetch() and load() return (error, data), load() returns None if nothing is cached.
+    refresh: fetch even if the data is cached, otherwise load() is tried again after getting the lock.
+    """
+    with _flights_lock:
+        future = _flights.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _flights[key] = future
+
+    if not is_leader:
+        logger.debug(f"Waiting for running request: {key}")
+        try:
+            error, data = future.result(timeout=SINGLE_FLIGHT_WAIT_TIMEOUT)
+            if data is not None:
+                return error, data
+        except Exception as e:
+            logger.warning(f"Shared request for {key} failed: {e}")
+        # Errors might be specific to the other user (e.g. login failed), so try it ourselves
+        return fetch()
+
+    try:
+        result = _distributed_flight(key, fetch, load, refresh)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+
+
+def _distributed_flight(key, fetch, load, refresh):
+    lock = redis.lock(key + ':lock', timeout=SINGLE_FLIGHT_LOCK_TIMEOUT)
+    channel = key + ':done'
+    if lock.acquire(blocking=False):
+        try:
+            # another instance might have filled the cache since the caller checked it
+            result = None if refresh else load()
+            return result if result is not None else fetch()
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+            redis.publish(channel, 1)
+
+    logger.debug(f"Waiting for other bot instance: {key}")
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(channel)
+        # check after subscribing, the other instance might have already finished
+        result = load()
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_TIMEOUT
+        while result is None and time.monotonic() < deadline:
+            if pubsub.get_message(timeout=max(0.0, deadline - time.monotonic())):
+                result = load()
+                break
+            if not lock.locked():  # other instance failed or crashed
+                break
+    finally:
+        pubsub.close()
+    return result if result is not None else fetch()
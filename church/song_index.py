@@ -0,0 +1,121 @@
+import re
+from bisect import bisect_left
+
+from church.ChurchToolsRequests import getCacheVersion
+from church.person_index import fold
+from church.utils import loadIndex
+
+# search filters: name -> field of the catalog
+_filters = {
+    'key': 'keys',
+    'tonart': 'keys',
+    'ccli': 'ccli',
+    'autor': 'authors',
+    'author': 'authors',
+}
+
+
+def _tokens(text):
+    return re.findall(r'\w+', fold(text))
+
+
+class _PrefixIndex:
+    """Sorted tokens and the song ids of each token, prefixes are found with a binary search"""
+    def __init__(self, token_songs):
+        self.tokens = sorted(token_songs)
+        self.songs = [token_songs[t] for t in self.tokens]
+
+    def search(self, prefix):
+        found = set()
+        i = bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            found |= self.songs[i]
+            i += 1
+        return found
+
+
+class SongCatalog:
+    """
+    Lookups derived from getAllSongs of churchservice, the songs themselves stay in the cached response.
+    order: song id -> position when sorted by title, files: file id -> (song id, arrangement id),
+    words: prefix index over the words of titles, authors and CCLI numbers,
+    authors: prefix index over the authors, keys: tonality -> song ids, ccli: CCLI number -> song ids
+    """
+    # increase when the structure changes, so catalogs stored by older versions are rebuilt
+    FORMAT = 2
+
+    def __init__(self, songs):
+        self.files = {}
+        self.keys = {}
+        self.ccli = {}
+        words = {}
+        authors = {}
+        for song_id, song in songs.items():
+            if not song_id:
+                continue
+            for token in _tokens(song.get('bezeichnung')):
+                words.setdefault(token, set()).add(song_id)
+            for token in _tokens(song.get('author')):
+                words.setdefault(token, set()).add(song_id)
+                authors.setdefault(token, set()).add(song_id)
+            ccli = str(song.get('ccli') or '').strip()
+            if ccli:
+                words.setdefault(ccli, set()).add(song_id)
+                self.ccli.setdefault(ccli, set()).add(song_id)
+            for ar_id, ar in (song.get('arrangement') or {}).items():
+                if ar.get('tonality'):
+                    self.keys.setdefault(ar['tonality'].strip().lower(), set()).add(song_id)
+                for file_id in ar.get('files') or {}:
+                    self.files[file_id] = (song_id, ar_id)
+        self.words = _PrefixIndex(words)
+        self.authors = _PrefixIndex(authors)
+        titles = sorted((fold(song.get('bezeichnung')), song_id) for song_id, song in songs.items() if song_id)
+        self.order = {song_id: i for i, (title, song_id) in enumerate(titles)}
+
+    def getFile(self, songs, song_id, file_id):
+        """The file of a song in songs (from getAllSongs), None if the file doesn't belong to the song"""
+        if file_id not in self.files or self.files[file_id][0] != song_id:
+            return None
+        song_id, ar_id = self.files[file_id]
+        try:
+            return songs[song_id]['arrangement'][ar_id]['files'][file_id]
+        except (KeyError, TypeError):
+            return None
+
+    def search(self, text):
+        """
+        Ids of the songs where each word of text is the beginning of a word of their title, author or CCLI number.
+        Filters like key=G, ccli=123 or autor=name restrict the results.
+        Returns the ids sorted by title and the requested key (or None).
+        """
+        found = None
+        key = None
+        for term in text.split():
+            name, sep, value = term.partition('=')
+            if sep and name.lower() in _filters:
+                field = _filters[name.lower()]
+                if field == 'keys':
+                    key = value.strip().lower()
+                    songs = self.keys.get(key, set())
+                elif field == 'ccli':
+                    songs = self.ccli.get(value.strip(), set())
+                else:
+                    songs = set.intersection(*[self.authors.search(t) for t in _tokens(value)] or [set()])
+            else:
+                tokens = _tokens(term)
+                if not tokens:
+                    continue
+                songs = set.intersection(*[self.words.search(t) for t in tokens])
+            found = songs if found is None else found & songs
+            if not found:
+                break
+        if not found:
+            return [], key
+        return sorted(found, key=self.order.__getitem__), key
+
+
+def getSongCatalog(login_data, songs):
+    version = getCacheVersion('service', 'getAllSongs', login_data=login_data)
+    if version:
+        version = f'{version}:{SongCatalog.FORMAT}'
+    return loadIndex(login_data, 'song_catalog', version, lambda: SongCatalog(songs))
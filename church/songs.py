@@ -4,22 +4,26 @@ from urllib.parse import urljoin
 
 import telegram
 
-from .ChurchToolsRequests import getAjaxResponse, download_file
+from . import media
+from .ChurchToolsRequests import getAjaxResponse, download_file, DAILY_DATA
+from .song_index import getSongCatalog
 from .utils import send_message
 
 logger = logging.getLogger(__name__)
 
-def _print_arrangements(song_id, j, arrangement_id=None):
+def _print_arrangements(song_id, j, arrangement_id=None, tonality=None):
     ret = ""
     for k in j:
         if not arrangement_id or arrangement_id == k:
             ar = j[k]
             if 'files' not in ar:
                 continue
+            if tonality and (ar.get('tonality') or '').strip().lower() != tonality:
+                continue
             ret += "\n"
 
             ret += f"<code>{ar['bezeichnung']}</code>"
-            if ar['tonality']:
+            if ar.get('tonality'):
                 ret += f" (<b>{ar['tonality']}</b>)"
             ret += "\n"
 
@@ -30,35 +34,30 @@ def _print_arrangements(song_id, j, arrangement_id=None):
                 # print(f"{kf}: {files[kf]}")
     return ret
 
-def byID(login_data, song_id, arrangement_id=None):
-    (error, data) = getAjaxResponse('service', 'getAllSongs', login_data=login_data, timeout=24 * 3600)
+def _getCatalog(login_data):
+    """(error, songs from getAllSongs, catalog of the songs)"""
+    (error, data) = getAjaxResponse('service', 'getAllSongs', login_data=login_data, stale=DAILY_DATA)
     if not data or 'songs' not in data:
+        return error, None, None
+    return error, data['songs'], getSongCatalog(login_data, data['songs'])
+
+
+def byID(login_data, song_id, arrangement_id=None):
+    (error, songs, catalog) = _getCatalog(login_data)
+    if not catalog:
         return False, error
-    else:
-        l = data['songs']
-        for k in l:
-            if not k:
-                continue
-            song = l[k]
-            if song['id'] == song_id:
-                return True, _print_song(song, login_data, arrangement_id=arrangement_id)
+    song = songs.get(song_id)
+    if song:
+        return True, _print_song(song, login_data, arrangement_id=arrangement_id)
     return False, 'Dieses Lied wurde nicht gefunden.'
 
 def search(login_data, name):
-    (error, data) = getAjaxResponse('service', 'getAllSongs', login_data=login_data, timeout=24 * 3600)
-    if not data or 'songs' not in data:
+    (error, all_songs, catalog) = _getCatalog(login_data)
+    if not catalog:
         return False, error
     else:
-        l = data['songs']
-        songs = []
-        for k in l:
-            if not k:
-                continue
-            song = l[k]
-            bez = song['bezeichnung']
-            author = song['author']
-            if name.lower() in bez.lower() or name.lower() in author.lower():
-                songs.append(song)
+        song_ids, tonality = catalog.search(name)
+        songs = [all_songs[s] for s in song_ids if s in all_songs]
 
         msgs = []
         cur_msg = ''
@@ -66,7 +65,7 @@ def search(login_data, name):
             return False, "Zu viele Lieder gefunden. Klicke auf Lieder, um deine Suche zu verfeinern."
         elif len(songs) > 0:
             for song in songs:
-                part = _print_song(song, login_data, short=len(songs) > 2)
+                part = _print_song(song, login_data, short=len(songs) > 2, tonality=tonality)
                 if not part:
                     continue
                 if cur_msg:
@@ -88,7 +87,7 @@ def search(login_data, name):
             return False, msgs
 
 
-def _print_song(song, login_data, short=False, arrangement_id=None):
+def _print_song(song, login_data, short=False, arrangement_id=None, tonality=None):
     songid = song["id"]
     url = urljoin(login_data['url'], f'?q=churchservice#/SongView/searchEntry:#{songid}')
     text = f'<a href="{url}">{song["bezeichnung"]}</a> /S{songid}\n'
@@ -96,7 +95,7 @@ def _print_song(song, login_data, short=False, arrangement_id=None):
         text += f"<i>{song['author']}</i>\n"
 
     if not short:
-        arr = _print_arrangements(songid, song['arrangement'], arrangement_id=arrangement_id)
+        arr = _print_arrangements(songid, song['arrangement'], arrangement_id=arrangement_id, tonality=tonality)
         if not arr:
             arr = '<i>Keine Dateien zu diesem Lied gefunden</i>\n'
         text += arr
@@ -105,29 +104,27 @@ def _print_song(song, login_data, short=False, arrangement_id=None):
 
 
 def download(login_data, song_id, file_id):
-    (error, data) = getAjaxResponse('service', 'getAllSongs', login_data=login_data, timeout=24 * 3600)
-    if error or not data or 'songs' not in data:
+    (error, songs, catalog) = _getCatalog(login_data)
+    if not catalog:
         return {'msg': error}
     else:
-        l = data['songs']
-        if song_id in l:
-            song = l[str(song_id)]
-            ars = song['arrangement']
-            for k in ars:
-                ar = ars[k]
-                if 'files' in ar:
-                    files = ar['files']
-                    if file_id in files:
-                        file = files[str(file_id)]
-                        logger.debug(file)
-                        file_hash = file['filename']
-                        url = urljoin(login_data['url'], f'?q=public/filedownload&filename={file_hash}')
-                        name = file['bezeichnung']
-                        logger.debug(f"Url: {url}\nFile: {name}")
-                        return {
-                            'file': url,
-                            'msg': name,
-                        }
+        file = catalog.getFile(songs, str(song_id), str(file_id))
+        if file:
+            logger.debug(file)
+            file_hash = file['filename']
+            url = urljoin(login_data['url'], f'?q=public/filedownload&filename={file_hash}')
+            name = file['bezeichnung']
+            logger.debug(f"Url: {url}\nFile: {name}")
+            return {
+                'file': url,
+                'msg': name,
+            }
+
+
+def _loadFile(login_data, url):
+    """The downloaded song file opened for reading, None if it couldn't be downloaded"""
+    (success, res) = download_file(login_data, url)
+    return res['file'] if success and res['type'] == 'file' else None
 
 
 def song(context, update, file_id, login_data, reply_markup, song_id):
@@ -136,19 +133,29 @@ def song(context, update, file_id, login_data, reply_markup, song_id):
         if res and 'msg' in res:
             msg = res['msg']
             if 'file' in res:
-                (success, res) = download_file(login_data, res['file'])
+                url = res['file']
+                file_id = media.getFileId(url)
+                if file_id:
+                    (success, res) = True, {'type': 'file', 'file': file_id}
+                else:
+                    (success, res) = download_file(login_data, url)
                 if success:
                     if res['type'] == 'file':
-                        context.bot.send_document(chat_id=update.message.chat_id, document=res['file'],
-                                          filename=msg,
-                                          parse_mode=telegram.ParseMode.HTML)
+                        try:
+                            media.sendDocument(context.bot, update.message.chat_id, url, res['file'],
+                                               lambda: _loadFile(login_data, url),
+                                               filename=msg,
+                                               parse_mode=telegram.ParseMode.HTML)
+                        finally:
+                            if not isinstance(res['file'], str):
+                                res['file'].close()
                     elif res['type'] == 'msg':
                         for msg in res['msg']:
                             send_message(context, update, msg, None, reply_markup)
                     else:  # file
                         send_message(context, update, res['file'], None, reply_markup)
                 else:
-                    send_message(context, update, res, None, reply_markup)
+                    send_message(context, update, str(res['msg']), None, reply_markup)
             else:
                 send_message(context, update, msg, None, reply_markup)
     except Exception as e:
@@ -0,0 +1,83 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from church.config import SPOOL_DIR, SPOOL_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# prefix of files that are still being written
+_TEMP_PREFIX = 'tmp-'
+_evict_lock = threading.Lock()
+
+
+class TooLarge(Exception):
+    pass
+
+
+def _path(source):
+    return os.path.join(SPOOL_DIR, hashlib.sha256(source.encode('utf-8')).hexdigest())
+
+
+def open_file(source):
+    """The spooled file of source opened for reading, None if it isn't on disk (anymore)"""
+    path = _path(source)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)  # mark as recently used
+    except OSError:
+        pass
+    return f
+
+
+def store(source, chunks, max_bytes):
+    """
+    Writes the chunks to the spool and returns the file opened for reading.
+    Raises TooLarge (and removes the partial file) as soon as more than max_bytes were written.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=SPOOL_DIR, prefix=_TEMP_PREFIX, delete=False) as f:
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise TooLarge(size)
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    path = _path(source)
+    os.replace(f.name, path)
+    _evict(keep=path)
+    return open(path, 'rb')
+
+
+def _evict(keep=None):
+    """Removes the least recently used files until the spool fits into SPOOL_MAX_BYTES"""
+    with _evict_lock:
+        files = []
+        total = 0
+        for entry in os.scandir(SPOOL_DIR):
+            if entry.name.startswith(_TEMP_PREFIX) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= SPOOL_MAX_BYTES:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)  # files that are still open for an upload stay readable until they're closed
+                total -= size
+            except OSError as e:
+                logger.warning(f"Couldn't remove {path} from the spool: {e}")
@@ -0,0 +1,30 @@
+import logging
+
+import telegram
+
+from church import redis
+
+logger = logging.getLogger(__name__)
+
+
+def _get_subscribers_key(url, topic):
+    return f'{topic}:subscribers:{url}'
+
+
+def subscribe(login_data, topic, chat_id, enabled=True):
+    """Adds or removes a chat from the notifications about topic of the instance"""
+    key = _get_subscribers_key(login_data['url'], topic)
+    if enabled:
+        redis.sadd(key, chat_id)
+    else:
+        redis.srem(key, chat_id)
+
+
+def notify(bot, login_data, topic, parts):
+    """Sends the message parts to all chats subscribed to topic of the instance"""
+    for chat_id in redis.smembers(_get_subscribers_key(login_data['url'], topic)):
+        for part in parts:
+            try:
+                bot.send_message(int(chat_id), text=part, parse_mode=telegram.ParseMode.HTML)
+            except Exception as e:
+                logger.error(f"Sending {topic} to {chat_id} failed: {e}")
@@ -1,11 +1,12 @@
 import logging
-import pickle
 from datetime import datetime
 
-from church import redis
+from church import redis, codec
 
 logger = logging.getLogger(__name__)
 
+_indexes = {}
+
 def get_cache_key(login_data, *args, useDate=False, usePerson=False, **kwargs):
     parts = list(args) + [login_data['url']]
     if usePerson:
@@ -20,7 +21,29 @@ def get_cache_key(login_data, *args, useDate=False, usePerson=False, **kwargs):
 
 def loadCache(key):
     entr_str = redis.get(key)
-    return pickle.loads(entr_str) if entr_str else None
+    return codec.decode(entr_str) if entr_str else None
+
+
+def loadIndex(login_data, name, version, build, timeout=7 * 24 * 3600):
+    """
+    Returns the structure created by build() for the given version of a dataset.
+    It's built once per version and shared with other bot instances via redis.
+    """
+    key = get_cache_key(login_data, name)
+    if version is None:
+        return build()
+    cached = _indexes.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    stored = loadCache(key)
+    if stored and stored[0] == version:
+        index = stored[1]
+    else:
+        logger.info(f"Building {name} for version {version}")
+        index = build()
+        redis.set(key, codec.encode((version, index)), ex=timeout)
+    _indexes[key] = (version, index)
+    return index
 
 
 def send_message(context, update, text, parse_mode, reply_markup):
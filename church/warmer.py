@@ -0,0 +1,189 @@
+import json
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from church import redis
+from church.CalendarBookingParser import CalendarBookingParser
+from church.ChurchToolsRequests import getAjaxResponse, DAILY_DATA
+from church.RoomBookingParser import RoomBookingParser
+from church.birthdays import parseGeburtstage, pushBirthdays
+from church.calendar import parseCalendarByTime
+from church.config import WARMER_AHEAD, WARMER_USER_TTL, WARMER_RETRY_AFTER, MASTER_DATA_TTL
+from church.person_index import getPersonDataVersion
+from church.phone_index import updatePhoneIndex
+from church.rooms import parseRaeumeByTime, room_markup
+from church.utils import get_cache_key
+
+logger = logging.getLogger(__name__)
+
+# cache_key: key of the cached data, it's refreshed if it expires soon
+# refresh: fetches the data and returns an error message or None
+# digests: renders the prepared messages based on the data after a successful refresh
+Dataset = namedtuple('Dataset', ['name', 'cache_key', 'refresh', 'digests'], defaults=[None])
+
+_instances_key = 'warmer:instances'
+
+
+def _ajax_dataset(name, *args, **kwargs):
+    return Dataset(
+        name=name,
+        cache_key=lambda login_data: get_cache_key(login_data, *args, additionalCacheKey=None),
+        refresh=lambda login_data: getAjaxResponse(*args, login_data=login_data, updateCache=True, **kwargs)[0])
+
+
+def _booking_dataset(name, parser, digests):
+    return Dataset(
+        name=name,
+        cache_key=lambda login_data: get_cache_key(login_data, parser(login_data).cache_key, useDate=True),
+        refresh=lambda login_data: parser(login_data).getAllBookings(updateCache=True)[0],
+        digests=digests)
+
+
+def buildRoomDigests(login_data):
+    parseRaeumeByTime(login_data, None, dayRange=0, updateDigest=True)
+    parseRaeumeByTime(login_data, None, dayRange=0, dayOffset=1, updateDigest=True)
+    for subset in room_markup:
+        parseRaeumeByTime(login_data, subset, dayRange=7, updateDigest=True)
+
+
+def buildCalendarDigests(login_data):
+    parseCalendarByTime(login_data, dayRange=0, updateDigest=True)
+    parseCalendarByTime(login_data, dayRange=0, dayOffset=1, updateDigest=True)
+    parseCalendarByTime(login_data, dayRange=7, updateDigest=True)
+
+
+def buildBirthdayDigests(login_data):
+    parseGeburtstage(login_data, updateDigest=True)
+
+
+def _refresh_persons(login_data):
+    (error, data) = getAjaxResponse('db', 'getAllPersonData', login_data=login_data, stale=DAILY_DATA,
+                                    updateCache=True)
+    if data:
+        updatePhoneIndex(login_data, getPersonDataVersion(login_data), data)
+    return error
+
+
+DATASETS = [
+    Dataset(name='Personen',
+            cache_key=lambda login_data: get_cache_key(login_data, 'db', 'getAllPersonData', additionalCacheKey=None),
+            refresh=_refresh_persons,
+            digests=buildBirthdayDigests),
+    _ajax_dataset('Stammdaten', 'db', 'getMasterData', timeout=MASTER_DATA_TTL),
+    _ajax_dataset('Lieder', 'service', 'getAllSongs', stale=DAILY_DATA),
+    _booking_dataset('Kalender', CalendarBookingParser, buildCalendarDigests),
+    Dataset(name='Kalender (alle)',
+            cache_key=lambda login_data: CalendarBookingParser(login_data).getFullBookingsKey(),
+            refresh=lambda login_data: CalendarBookingParser(login_data).getFullBookings(updateCache=True)[0]),
+    _booking_dataset('Räume', RoomBookingParser, buildRoomDigests),
+]
+
+
+def _get_user_key(url):
+    return f'warmer:user:{url}'
+
+
+def _get_status_key(url, dataset):
+    return f'warmer:status:{url}:{dataset.name}'
+
+
+def remember_user(login_data):
+    """Remembers an active user, whose login is used to refresh the data of the instance."""
+    redis.set(_get_user_key(login_data['url']), json.dumps(login_data), ex=WARMER_USER_TTL)
+    redis.sadd(_instances_key, login_data['url'])
+
+
+def _failed_recently(login_data, dataset):
+    status_str = redis.get(_get_status_key(login_data['url'], dataset))
+    if not status_str:
+        return False
+    status = json.loads(status_str)
+    return bool(status['error']) and datetime.now().timestamp() - status['time'] < WARMER_RETRY_AFTER
+
+
+def _needs_refresh(login_data, dataset):
+    if _failed_recently(login_data, dataset):
+        return False
+    ttl = redis.ttl(dataset.cache_key(login_data))
+    # -2: key doesn't exist, -1: key has no expiry
+    return ttl == -2 or 0 <= ttl < WARMER_AHEAD
+
+
+def active_logins():
+    """Login data of a recently active user for each known instance"""
+    for url in sorted(u.decode('utf-8') for u in redis.smembers(_instances_key)):
+        login_data_str = redis.get(_get_user_key(url))
+        if not login_data_str:
+            logger.debug(f"No active user for {url}")
+            continue
+        yield json.loads(login_data_str)
+
+
+def warm(context=None):
+    """
+    JobQueue callback, refreshes at most one dataset per call, so the requests are spread out over time.
+    If a refresh fails, the next dataset is tried and the failed one is skipped for WARMER_RETRY_AFTER.
+    """
+    for login_data in active_logins():
+        for dataset in DATASETS:
+            if _needs_refresh(login_data, dataset) and not _refresh(login_data, dataset):
+                return
+
+
+def _refresh(login_data, dataset):
+    logger.info(f"Refreshing {dataset.name} for {login_data['url']}")
+    start = time.monotonic()
+    try:
+        error = dataset.refresh(login_data)
+    except Exception as e:
+        logger.warning(f"Refreshing {dataset.name} failed: {e}")
+        error = str(e)
+    status = {
+        'time': datetime.now().timestamp(),
+        'duration': time.monotonic() - start,
+        'error': error,
+    }
+    redis.set(_get_status_key(login_data['url'], dataset), json.dumps(status))
+    if not error and dataset.digests:
+        _buildDigests(login_data, dataset.digests)
+    return error
+
+
+def _buildDigests(login_data, build):
+    try:
+        build(login_data)
+    except Exception as e:
+        logger.warning(f"{build.__name__} failed for {login_data['url']}: {e}")
+
+
+def refreshDigests(context=None):
+    """JobQueue callback after midnight, renders the messages of "Heute", "Morgen", .. for the new day"""
+    for login_data in active_logins():
+        for build in [buildRoomDigests, buildCalendarDigests, buildBirthdayDigests]:
+            _buildDigests(login_data, build)
+
+
+def status_message(login_data):
+    msg = '<b>Hintergrund-Aktualisierung</b>\n'
+    for dataset in DATASETS:
+        status_str = redis.get(_get_status_key(login_data['url'], dataset))
+        if not status_str:
+            msg += f'{dataset.name}: <i>noch nicht aktualisiert</i>\n'
+            continue
+        status = json.loads(status_str)
+        msg += f'{dataset.name}: {datetime.fromtimestamp(status["time"]):%d.%m. %H:%M} ({status["duration"]:.1f}s)'
+        if status['error']:
+            msg += f' <i>{status["error"]}</i>'
+        msg += '\n'
+    return msg
+
+
+def pushDailyBirthdays(context):
+    """JobQueue callback in the morning, sends the birthdays of the day to the subscribers of each instance"""
+    for login_data in active_logins():
+        try:
+            pushBirthdays(context.bot, login_data)
+        except Exception as e:
+            logger.warning(f"Sending birthdays for {login_data['url']} failed: {e}")
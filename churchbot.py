@@ -7,30 +7,35 @@ import traceback
 
 import json
 import re
+from datetime import datetime, time
 
 from telegram.utils.request import Request
 
-from church.birthdays import parseGeburtstage
+from church.birthdays import parseGeburtstage, parseGeburtstageMonat, parseGeburtstageGruppe
 from church.bot import MQBot
 from church.calendar import parseCalendarByText, calendar
 from church.event import parse_signup, list_events, agenda, print_event
 from church.groups import group, print_group_members
 from church.login_utils import button, photo, check_login
+from church.master_data import getMasterData
 from church.markup import MARKUP_ROOMS, MARKUP_CALENDAR, MARKUP_BIRTHDAYS, MARKUP_PEOPLE, MARKUP_GROUPS, MARKUP_SONGS, \
     MARKUP_EVENTS, mainMarkup, RAUM_ZEIT_MARKUP, RAUM_EXTENDED_MARKUP, EMPTY_MARKUP, RAUM_ZEIT_MARKUP_SIMPLE, \
-    RAUM_ZEIT_MARKUP_EXTENDED
+    RAUM_ZEIT_MARKUP_EXTENDED, RAUM_FREE_MARKUP
 from church.persons import person, printPersonGroups
-from church.rooms import parseRaeumeByTime, parseRaeumeByText, room_markup
-from church.ChurchToolsRequests import get_user_login_key, login, getAjaxResponse
+from church.rooms import parseRaeumeByTime, parseRaeumeByText, room_markup, parseFreieRaeume, \
+    parseNaechsterFreierTermin
+from church.ChurchToolsRequests import get_user_login_key, login, getAjaxResponse, DAILY_DATA
 from church.songs import song
 from church.utils import send_message, mode_key
+from church.config import WARMER_INTERVAL, CONFLICTS_INTERVAL, BIRTHDAYS_PUSH_HOUR, TIMEZONE
 
 #locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
 
+import pytz
 import telegram
 from telegram import ReplyKeyboardMarkup
 from telegram.ext import Updater, Filters, MessageHandler, messagequeue as mq, CallbackQueryHandler
-from church import songs, groups, redis
+from church import songs, groups, redis, warmer, conflicts, birthdays, media
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +65,7 @@ def message(update, context):
         if not success:
             check_login(context, update, text, firstTime=False)
             return
+        warmer.remember_user(login_data)
     else:
         # not logged in, check if login data sent and don't continue afterwards
         check_login(context, update, text)
@@ -91,6 +97,10 @@ def message(update, context):
                 redis.set(mode_key(update), 'room_search')
                 send_message(context, update, "Gib den Namen der Raumbelegung (oder einen Teil ein):", None,
                              EMPTY_MARKUP)
+            elif text in RAUM_FREE_MARKUP:
+                redis.set(mode_key(update), 'room_free')
+                send_message(context, update, "Wann? z.B. <code>So 14-16</code> oder <code>24.12. 18:00-20:00</code>",
+                             telegram.ParseMode.HTML, EMPTY_MARKUP)
         elif mode == 'song':
             (success, res) = songs.search(login_data, text)
             if success:
@@ -108,6 +118,10 @@ def message(update, context):
             msgs = parseRaeumeByText(login_data, text)
             for msg in msgs:
                 send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
+        elif mode == 'room_free':
+            msgs = parseFreieRaeume(login_data, text)
+            for msg in msgs:
+                send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
         elif mode == 'calendar_search':
             try:
                 msgs = parseCalendarByText(login_data, text)
@@ -129,11 +143,13 @@ def message(update, context):
         mPersonGroup = re.match('/PG([0-9]+)', text)
         mGroup = re.match('/G([0-9]+)', text)
         mGroupMember = re.match('/GP([0-9]+)', text)
+        mGroupBirthdays = re.match('/GB([0-9]+)', text)
         mEvent = re.match('/E([0-9]+)', text)
         mQR = re.match('/Q([0-9]+)', text)
         mAgenda = re.match('/A([0-9]+)', text)
         mSong1 = re.match('/S([0-9]+)$', text)
         mSong2 = re.match('/S([0-9]+)_([0-9]+)', text)
+        mRoomFree = re.match('/F([0-9]+)_([0-9]{12})_([0-9]+)', text)
         if m1:
             zeit = m1.group(1)
             room = m1.group(2)
@@ -162,7 +178,7 @@ def message(update, context):
             person(context, update, text, mainMarkup(), login_data, include_pi=include_pi, contact=True)
         elif mPersonGroup:
             try:
-                (error, data) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, timeout=24 * 3600)
+                (error, data) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, stale=DAILY_DATA)
                 if not data:
                     msg = '<i>Konnte Daten nicht abrufen!</i>'
                 else:
@@ -178,11 +194,14 @@ def message(update, context):
                 msg = f"Failed!\nException: {eMsg}"
                 logger.error(msg)
                 send_message(context, update, msg, None, mainMarkup())
+        elif mGroupBirthdays:
+            for msg in parseGeburtstageGruppe(login_data, mGroupBirthdays.group(1)):
+                send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
         elif mGroup:
             group(context, update, text, mainMarkup(), login_data=login_data)
         elif mGroupMember:
-            (error, data) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, timeout=24 * 3600)
-            (errorMaster, masterData) = getAjaxResponse("db", "getMasterData", login_data=login_data, timeout=None)
+            (error, data) = getAjaxResponse("db", "getAllPersonData", login_data=login_data, stale=DAILY_DATA)
+            (errorMaster, masterData) = getMasterData(login_data)
             if not data or not masterData:
                 parts = ['<i>Konnte Daten nicht abrufen!</i>']
             else:
@@ -198,10 +217,10 @@ def message(update, context):
             qr = groups.get_qrcode(login_data, g_id)
             if qr:
                 try:
-                    bot.send_photo(update.effective_chat.id, photo=qr,
-                                      caption="QR-Code fürs Check-In",
-                                      parse_mode=telegram.ParseMode.HTML, reply_markup=mainMarkup(),
-                                      timeout=30)
+                    media.sendPhoto(bot, update.effective_chat.id, *qr,
+                                    caption="QR-Code fürs Check-In",
+                                    parse_mode=telegram.ParseMode.HTML, reply_markup=mainMarkup(),
+                                    timeout=30)
                 except Exception as e:
                     send_message(context, update,
                                  "<i>Konnte QR-Code nicht senden :(</i>\n" + str(e),
@@ -228,6 +247,11 @@ def message(update, context):
                 msg = f"Failed!\nException: {eMsg}"
                 logger.error(msg)
                 send_message(context, update, msg, None, mainMarkup())
+        elif mRoomFree:
+            start = datetime.strptime(mRoomFree.group(2), '%Y%m%d%H%M')
+            msgs = parseNaechsterFreierTermin(login_data, int(mRoomFree.group(1)), start, int(mRoomFree.group(3)))
+            for msg in msgs:
+                send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
         elif mAgenda:
             a_id = mAgenda.group(1)
             agenda(context, update, login_data, a_id, mainMarkup())
@@ -235,22 +259,23 @@ def message(update, context):
         elif text == MARKUP_ROOMS:
             redis.set(mode_key(update), 'rooms')
             send_message(context, update, "Welcher Zeitraum?", telegram.ParseMode.HTML,
-                         ReplyKeyboardMarkup([RAUM_ZEIT_MARKUP, RAUM_EXTENDED_MARKUP]))
+                         ReplyKeyboardMarkup([RAUM_ZEIT_MARKUP, RAUM_EXTENDED_MARKUP + RAUM_FREE_MARKUP]))
         elif text == MARKUP_CALENDAR:
             redis.set(mode_key(update), 'calendar')
             send_message(context, update, "Welcher Zeitraum?", telegram.ParseMode.HTML,
                          ReplyKeyboardMarkup([RAUM_ZEIT_MARKUP, RAUM_EXTENDED_MARKUP]))
         elif text == MARKUP_BIRTHDAYS:
             try:
-                msg = parseGeburtstage(login_data=login_data)
-                send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
+                for part in parseGeburtstage(login_data=login_data):
+                    send_message(context, update, part, telegram.ParseMode.HTML, mainMarkup())
             except Exception as e:
                 msg = f"Failed!\nException: {e}"
                 logger.error(msg)
                 send_message(context, update, msg, None, mainMarkup())
         elif text == MARKUP_SONGS:
             redis.set(mode_key(update), 'song')
-            send_message(context, update, "Gib den Namen/Author (oder einen Teil davon ein):", None,
+            send_message(context, update, "Gib den Namen/Author (oder den Anfang der Wörter) ein, "
+                                          "optional mit Tonart, z.B. gott key=G:", None,
                          EMPTY_MARKUP)
         elif text == MARKUP_PEOPLE:
             redis.set(mode_key(update), 'person')
@@ -261,6 +286,20 @@ def message(update, context):
             send_message(context, update, "Gib den Namen (oder einen Teil ein):", None, EMPTY_MARKUP)
         elif text == MARKUP_EVENTS:
             list_events(context, login_data, mainMarkup(), update)
+        elif text == '/konflikte':
+            for msg in conflicts.parseKonflikte(login_data):
+                send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
+        elif text in ['/konflikte_an', '/konflikte_aus']:
+            msg = conflicts.subscribe(login_data, update.message.chat_id, enabled=text == '/konflikte_an')
+            send_message(context, update, msg, None, mainMarkup())
+        elif text == '/geburtstage_monat':
+            for msg in parseGeburtstageMonat(login_data):
+                send_message(context, update, msg, telegram.ParseMode.HTML, mainMarkup())
+        elif text in ['/geburtstage_an', '/geburtstage_aus']:
+            msg = birthdays.subscribe(login_data, update.message.chat_id, enabled=text == '/geburtstage_an')
+            send_message(context, update, msg, None, mainMarkup())
+        elif text == '/status':
+            send_message(context, update, warmer.status_message(login_data), telegram.ParseMode.HTML, mainMarkup())
         else:
             send_message(context, update,
                          "Unbekannter Befehl, du kannst einen der Buttons unten nutzen", None, mainMarkup())
@@ -286,6 +325,16 @@ if __name__ == '__main__':
 
     # updater.dispatcher.add_handler()
 
+    # refresh large datasets before they expire
+    updater.job_queue.run_repeating(warmer.warm, interval=WARMER_INTERVAL, first=WARMER_INTERVAL)
+    timezone = pytz.timezone(TIMEZONE)
+    # prepare the messages for the new day
+    updater.job_queue.run_daily(warmer.refreshDigests, time(0, 5, tzinfo=timezone))
+    # send the birthdays of the day to subscribers
+    updater.job_queue.run_daily(warmer.pushDailyBirthdays, time(BIRTHDAYS_PUSH_HOUR, 0, tzinfo=timezone))
+    # notify subscribers about new double bookings of rooms
+    updater.job_queue.run_repeating(conflicts.checkConflicts, interval=CONFLICTS_INTERVAL, first=CONFLICTS_INTERVAL)
+
     logger.info("Starting updater..")
     updater.start_polling()
     updater.idle()